@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import os.path
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import concurrent.futures
+
+import img2mhd
+
+
+
+# ================================================================================
+#                   Error codes returned by the program
+# ================================================================================
+ERR_PARAMS_INCORRECT = 1    # parameters incorrect
+ERR_CASE = 2                # benchmark case failed
+
+
+# ================================================================================
+#               Image formats (file extension) and modes benchmarked
+#
+#   Floating point slices can not be saved as PNG/ JPEG/ BMP, IM is used instead.
+# ================================================================================
+FORMATS = {
+    "PNG" : ("png", ["L", "I;16"]),
+    "JPEG" : ("jpeg", ["L"]),
+    "BMP" : ("bmp", ["L"]),
+    "IM" : ("im", ["L", "I;16", "F"])
+}
+
+
+# ================================================================================
+#       Prints the help message (also done when something went wrong!)
+# ================================================================================
+def printHelp():
+    print("\nbenchmark_img2mhd.py : Benchmarking the conversion paths of img2mhd.py\n"
+            + "=======================================================================\n")
+
+    print("USAGE:\n"
+            + "\tpython3 benchmark_img2mhd.py -out {File} -types {Types} -modes {Modes} -slices {Numbers}\n"
+            + "\t\t\t\t-sizes {Numbers} -raw {Types} -jobs {Numbers} -work {Folder} -compare {File}\n\n\n"
+            + "Output:\t\t\tResults as JSON\n"
+            + "\t\t\t=> Default: benchmark.json\n\n"
+            + "Image types:\t\t{PNG | JPEG | BMP | IM} (comma separated)\n"
+            + "\t\t\t=> Default: PNG,JPEG,BMP,IM\n\n"
+            + "Image modes:\t\t{L | I;16 | F} (comma separated, unsupported combinations are skipped)\n"
+            + "\t\t\t=> Default: L,I;16,F\n\n"
+            + "Number of slices:\t{10 ... 2000} (comma separated)\n"
+            + "\t\t\t=> Default: 10,100\n\n"
+            + "Slice sizes:\t\t{256 ... 2048} (comma separated, width = height)\n"
+            + "\t\t\t=> Default: 256,512\n\n"
+            + "RAW output:\t\t{Simple | Multiple | Compressed} (comma separated)\n"
+            + "\t\t\t=> Default: Simple,Multiple\n\n"
+            + "Number of jobs:\t\t{Numbers of parallel workers} (comma separated)\n"
+            + "\t\t\t=> Default: 1\n\n"
+            + "Work folder:\t\tFolder for the synthetic slices (kept between runs)\n"
+            + "\t\t\t=> Default: temporary folder (removed afterwards)\n\n"
+            + "Compare:\t\tResults (JSON) of another run to compare against\n")
+
+
+# ================================================================================
+#           Validates that all parameters given are correct!
+# ================================================================================
+def validateParameters(args):
+    defaults = {
+        "-out" : "benchmark.json",
+        "-types" : "PNG,JPEG,BMP,IM",
+        "-modes" : "L,I;16,F",
+        "-slices" : "10,100",
+        "-sizes" : "256,512",
+        "-raw" : "Simple,Multiple",
+        "-jobs" : "1",
+        "-work" : None,
+        "-compare" : None
+    }
+
+    # Assert parameters always followed by values
+    if len(args) % 2 != 0:
+        return None
+
+    res = dict(defaults)
+    for i in range(0, len(args), 2):
+        if args[i] not in defaults or args[i+1].startswith("-"):
+            return None
+        res[args[i]] = args[i+1]
+
+    try:
+        return {
+            "out" : res["-out"],
+            "types" : [given.upper() for given in res["-types"].split(",")],
+            "modes" : res["-modes"].split(","),
+            "slices" : [int(given) for given in res["-slices"].split(",")],
+            "sizes" : [int(given) for given in res["-sizes"].split(",")],
+            "raw" : [given.capitalize() for given in res["-raw"].split(",")],
+            "jobs" : [int(given) for given in res["-jobs"].split(",")],
+            "work" : res["-work"],
+            "compare" : res["-compare"]
+        }
+    except ValueError:
+        return None
+
+
+# ================================================================================
+#       Creates a synthetic slice stack (and Meta.json) if not existing yet
+#
+#   Slices are a smooth gradient with noise, so that compression and decoding
+#   behave more like medical data than pure noise would.
+# ================================================================================
+def createStack(work, img_type, mode, slices, size):
+    import numpy
+    from PIL import Image
+
+    extension = FORMATS[img_type][0]
+    folder = os.path.join(work, f"{img_type}-{mode.replace(';', '')}-{slices}-{size}")
+    if os.path.isfile(os.path.join(folder, "done")):
+        return folder
+
+    os.makedirs(folder, exist_ok=True)
+    rng = numpy.random.default_rng(slices * size)
+
+    gradient = numpy.add.outer(numpy.arange(size), numpy.arange(size)) / (2 * size)
+    maximum = {"L" : 255, "I;16" : 4095, "F" : 1}[mode]
+
+    for i in range(0, slices):
+        data = (gradient + rng.normal(0, 0.05, (size, size)) + i / slices) % 1 * maximum
+
+        if mode == "L":
+            im = Image.fromarray(data.astype(numpy.uint8))
+        elif mode == "I;16":
+            im = Image.frombytes("I;16", (size, size), data.astype("<u2").tobytes())
+        else:
+            im = Image.fromarray(data.astype(numpy.float32))
+
+        im.save(os.path.join(folder, f"slice.{i}.{extension}"))
+
+    with open(os.path.join(folder, "Meta.json"), "w") as meta:
+        json.dump({
+            "MRA" : {
+                "columns" : size,
+                "rows" : size,
+                "number of slices" : slices,
+                "slice thickness" : 0.5,
+                "pixel spacing" : [0.4, 0.4],
+                "slice spacing" : 0.5,
+                "anatomical orientation" : "RAI"
+            }
+        }, meta)
+
+    open(os.path.join(folder, "done"), "w").close()
+    return folder
+
+
+# ================================================================================
+#       Returns the number of bytes of all files in the given folder
+# ================================================================================
+def getBytesWritten(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+# ================================================================================
+#       Runs one benchmark case (called in a fresh process for every case)
+#
+#   Every stage of the img2mhd.py pipeline is timed by img2mhd.Profile, the same
+#   way as -profile does. readHeader is a stage of its own, the validateImage,
+#   consistency and validateMeta stages are recorded within it (so the wall time
+#   of the case only sums up readHeader, raw and mhd).
+# ================================================================================
+def runCase(case):
+    profile = img2mhd.Profile()
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=case["jobs"]) if case["jobs"] > 1 else None
+    meta = os.path.join(case["folder"], "Meta.json")
+
+    with img2mhd.profileStage(profile, "readHeader"):
+        header = img2mhd.readHeader(case["folder"], meta, case["type"], "MRA", pool, profile)
+    files = header.files
+
+    shutil.rmtree(case["output"], ignore_errors=True)
+    os.makedirs(case["output"])
+
+    with img2mhd.profileStage(profile, "raw"):
+        if case["raw"] == "Simple":
+            img2mhd.writeRAWSimple(
+                files, os.path.join(case["output"], "output.raw"), header.dtype, header.shape[1:], pool, profile=profile)
+        elif case["raw"] == "Multiple":
+            img2mhd.writeRAWMultiple(files, case["output"], header.dtype, pool, profile=profile)
+        else:
+            img2mhd.writeRAWCompressed(
+                files, os.path.join(case["output"], "output.zraw"), header.dtype, pool, profile=profile, jobs=case["jobs"])
+
+    with img2mhd.profileStage(profile, "mhd"):
+        img2mhd.writeMHD(os.path.join(case["output"], "output.mhd"), header)
+
+    if pool is not None:
+        pool.shutdown()
+
+    stages = {
+        name : {key : round(value, 6) if isinstance(value, float) else value for key, value in stage.items()}
+        for name, stage in profile.stages.items()
+    }
+
+    return {
+        "stages" : stages,
+        "wall" : round(sum(stages[name]["wall"] for name in ["readHeader", "raw", "mhd"]), 6),
+        "peak_rss" : img2mhd.getPeakRSS(),
+        "bytes_written" : getBytesWritten(case["output"])
+    }
+
+
+# ================================================================================
+#               Returns the current git commit (if run inside a repository)
+# ================================================================================
+def getCommit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+# ================================================================================
+#       Prints the results next to the ones of another run (same cases only)
+# ================================================================================
+def compareResults(results, path):
+    with open(path, "r") as in_file:
+        other = json.load(in_file)
+
+    def key(result):
+        return tuple(result[field] for field in ["type", "mode", "slices", "size", "raw", "jobs"])
+
+    previous = {key(result) : result for result in other["results"]}
+
+    print(f"\nCompared to {other.get('commit')}:")
+    for result in results:
+        if key(result) in previous:
+            before = previous[key(result)]
+            print(f"\t{' '.join(str(value) for value in key(result)):40}"
+                    + f" wall {before['wall']:9.3f}s -> {result['wall']:9.3f}s"
+                    + f" ({result['wall'] / max(before['wall'], 1e-9):6.2f}x)"
+                    + f"  peak {before['peak_rss'] >> 20:6d} -> {result['peak_rss'] >> 20:6d} MiB")
+
+
+# ================================================================================
+#                                   MAIN-ROUTINE:
+#   1) Validate parameters (or run a single case in this process)
+#   2) Create synthetic slice stacks
+#   3) Run every case in a fresh process
+#   4) Output results (and compare to another run)
+# ================================================================================
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    #   Single case (in a fresh process, so peak memory is its own)
+    #   ===========================================================
+    if len(args) == 2 and args[0] == "-case":
+        print(json.dumps(runCase(json.loads(args[1]))))
+        exit(0)
+
+
+    #   Validate parameters
+    #   ===================
+    res = validateParameters(args)
+    if not res:
+        print("Parameters are not correct!")
+        printHelp()
+        exit(ERR_PARAMS_INCORRECT)
+
+    work = res["work"] or tempfile.mkdtemp(prefix="img2mhd-benchmark-")
+
+    results = []
+    try:
+        for img_type in res["types"]:
+            for mode in res["modes"]:
+                if img_type not in FORMATS or mode not in FORMATS[img_type][1]:
+                    # Combination can not be saved by PIL
+                    continue
+
+                for slices in res["slices"]:
+                    for size in res["sizes"]:
+                        #   Create synthetic slice stack
+                        #   ============================
+                        folder = createStack(work, img_type, mode, slices, size)
+
+                        for raw in res["raw"]:
+                            for jobs in res["jobs"]:
+                                #   Run case in a fresh process
+                                #   ===========================
+                                case = {
+                                    "type" : img_type, "mode" : mode, "slices" : slices, "size" : size,
+                                    "raw" : raw, "jobs" : jobs,
+                                    "folder" : folder, "output" : os.path.join(work, "output")
+                                }
+
+                                run = subprocess.run(
+                                    [sys.executable, os.path.abspath(__file__), "-case", json.dumps(case)],
+                                    capture_output=True, text=True
+                                )
+                                if run.returncode != 0:
+                                    print(run.stderr)
+                                    print(f"Benchmark case failed: {case}")
+                                    exit(ERR_CASE)
+
+                                result = dict(case, **json.loads(run.stdout.splitlines()[-1]))
+                                del result["folder"], result["output"]
+                                results.append(result)
+
+                                print(f"{img_type:5} {mode:5} {slices:5} x {size:4}^2  {raw:10} jobs {jobs:3}"
+                                        + f"  wall {result['wall']:9.3f}s  peak {result['peak_rss'] >> 20:6d} MiB"
+                                        + f"  written {result['bytes_written'] >> 20:6d} MiB")
+    finally:
+        if not res["work"]:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+    #   Output results
+    #   ==============
+    with open(res["out"], "w") as out_file:
+        json.dump({
+            "commit" : getCommit(),
+            "date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count(),
+            "results" : results
+        }, out_file, indent=4)
+
+    if res["compare"]:
+        compareResults(results, res["compare"])
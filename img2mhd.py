@@ -5,10 +5,17 @@ import re
 import sys
 import os
 import os.path
+import io
+import csv
+import collections
+import bisect
+import contextlib
 import json
-import numpy
-import imghdr
-from PIL import Image
+import time
+import zlib
+import hashlib
+import threading
+import concurrent.futures
 
 
 
@@ -27,6 +34,24 @@ ERR_META = 9                # meta information incorrect
 ERR_META_AO = 10            # anatomical orientation in meta data is wrong
 ERR_IMG_TYPE_DEPTH = 11     # input image data types incorrect
 ERR_IMG_NAMES = 12          # input image names incorrect
+ERR_JOBS = 13               # number of jobs incorrect
+ERR_MANIFEST = 14           # batch manifest incorrect
+ERR_BATCH = 15              # at least one batch job failed
+ERR_CACHE = 16              # cache option incorrect
+ERR_COMPRESS = 17           # compression option incorrect
+ERR_PROFILE = 18            # profile option incorrect
+ERR_ELEMENT = 19            # element type incorrect
+ERR_PYRAMID = 20            # pyramid levels incorrect
+ERR_RANGE = 21              # slice range incorrect
+ERR_CROP = 22               # crop box incorrect
+ERR_WATCH = 23              # watch option incorrect
+ERR_INDEX = 24              # directory index option incorrect
+ERR_STATS = 25              # statistics/ window option incorrect
+ERR_ORIENT = 26             # target orientation incorrect
+ERR_MASK = 27               # mask option or mask slices incorrect
+ERR_SHARD = 28              # shard incorrect or shards incomplete
+ERR_MEMORY = 29             # memory budget incorrect
+ERR_COLOR = 30              # color conversion incorrect
 
 
 
@@ -42,7 +67,7 @@ def printHelp(topic = None):
                 + "Info: Type of image input series, MRA or DSA!\n")
     elif topic == "input":
         print("Help: Input file/ folder\n"
-                + "Info: Path to the image input, one single file or folder with multiple!\n")
+                + "Info: Path to the image input, one single file (every frame of a multi-frame file is a slice) or folder with multiple!\n")
     elif topic == "meta":
         print("Help: Meta file\n"
                 + "Info: File containing the meta information for the MHD format!\n")
@@ -51,25 +76,129 @@ def printHelp(topic = None):
                 + "Info: Path for this scripts output!\n")
     elif topic == "raw":
         print("Help: RAW output file(s)\n"
-                + "Info: Whether the raw image output should be saved in a simple or in multiple files\n")
+                + "Info: Whether the raw image output should be saved in a simple or in multiple files\n"
+                + "      (or for volume input NPY/ RAW be referenced in place without copying)\n")
+    elif topic == "element":
+        print("Help: Element type\n"
+                + "Info: MET type of the voxels of a RAW volume input (MET_UCHAR, MET_USHORT, MET_FLOAT, ...)!\n"
+                + "      Auto writes image input with the smallest integer type holding all its values (found while decoding)!\n"
+                + "      Known after the last slice only, the RAW output is narrowed in one more pass (if the type changes)!\n")
+    elif topic == "pyramid":
+        print("Help: Pyramid levels\n"
+                + "Info: Downsampling factors (e.g. 2,4,8) of additional MHD/ RAW outputs (output_2x.mhd, ...) for multi-resolution registration!\n")
+    elif topic == "range":
+        print("Help: Slice range\n"
+                + "Info: Positions First:Last (Last excluded, both optional) of the sorted slices to convert, other slices are never read!\n")
+    elif topic == "crop":
+        print("Help: Crop box\n"
+                + "Info: X,Y,Width,Height (in pixels) of every slice to convert, the MHD Offset keeps the sub-volume in place!\n")
+    elif topic == "watch":
+        print("Help: Watch folder\n"
+                + "Info: Seconds to wait for new slices, which are written to output.raw in the order of their numbers as soon as they arrive (DimSize kept current)!\n")
+    elif topic == "index":
+        print("Help: Directory index\n"
+                + "Info: Whether the sorted slice list is kept (output.index.json) and reused while the input folder is unchanged!\n")
+    elif topic == "stats":
+        print("Help: Volume statistics\n"
+                + "Info: Whether minimum, maximum, mean, percentiles and histogram are written to output.stats.json (gathered while decoding)!\n")
+    elif topic == "window":
+        print("Help: Intensity window\n"
+                + "Info: Percentiles Low,High (e.g. 0.5,99.5) to clip to and rescale to the full range of the element type (-element MET_X)!\n")
+    elif topic == "mask":
+        print("Help: Label mask\n"
+                + "Info: Whether the mask of every slice (same number, \"mask\" in its name) is converted in the same pass to output_mask.mhd (MET_UCHAR)!\n")
+    elif topic == "shard":
+        print("Help: Shard\n"
+                + "Info: Part I/N (counted from 0) or range First:Last of the slices written into the shared output.raw by this process,\n"
+                + "      Finalize writes output.mhd once every shard completed!\n")
+    elif topic == "color":
+        print("Help: Color conversion\n"
+                + "Info: Color or palette slices written as one scalar per voxel, Luminance (palette colors looked up) or one band (R, G, B, A, ...),\n"
+                + "      or as vector image (Vector, ElementNumberOfChannels)!\n")
+    elif topic == "max-memory":
+        print("Help: Memory budget\n"
+                + "Info: MiB of slice files read ahead of decoding (and LIST 2D slices written behind it) for slow or networked storage!\n")
+    elif topic == "orient":
+        print("Help: Target orientation\n"
+                + "Info: Anatomical orientation (e.g. RAI) the voxels are flipped and permuted to slab-wise, AnatomicalOrientation given in Meta.json is the one of the input!\n")
+    elif topic == "jobs":
+        print("Help: Number of jobs\n"
+                + "Info: Number of slices decoded and written in parallel!\n")
+    elif topic == "cache":
+        print("Help: Incremental conversion cache\n"
+                + "Info: Whether only changed slices should be converted again (cache stored next to output.mhd)!\n")
+    elif topic == "compress":
+        print("Help: Compressed RAW output\n"
+                + "Info: Whether the raw image output should be zlib compressed (.zraw)!\n")
+    elif topic == "profile":
+        print("Help: Profile report\n"
+                + "Info: JSON file to write time, I/O and memory of every stage to (-latency True adds slice latencies)!\n")
+    elif topic == "batch":
+        print("Help: Batch manifest\n"
+                + "Info: JSON list or CSV file of series to convert, with fields in, meta, series, out (and optional type, raw, cache, compress, element, pyramid, range, crop, index, stats, window, orient, mask, shard, max-memory, color)!\n")
     elif topic == None:
         print("\nimg2mhd.py : Converting sliced image(s) and metadata to mhd (+raw) format\n"
                 + "=========================================================================\n")
 
         print("USAGE:\n"
-                + "\tpython3 img2mhd.py -type {Image type} -series {Series} -in {Files} -meta {Files} -out {File} -raw {Type}\n\n\n"
-                + "Image type:\t\t{JPG/JPEG | BMP/DIB | XBM/XPM | PPM/PBM/PGM/PNM | PNG | EPS | IM | TGA | WEBP | FPX | PCD | PIXAR | PSD}\n"
+                + "\tpython3 img2mhd.py -type {Image type} -series {Series} -in {Files} -meta {Files} -out {File} -raw {Type} -element {Type} -jobs {Number} -cache {Cache} -compress {Compress}\n"
+                + "\t\t\t-range {First:Last} -crop {X,Y,Width,Height} -pyramid {Levels} -watch {Seconds} -index {Index}\n"
+                + "\t\t\t-stats {Stats} -window {Low,High} -orient {Code} -mask {Mask}\n"
+                + "\t\t\t-shard {I/N | First:Last | Finalize} -max-memory {MiB} -color {Conversion}\n"
+                + "\t\t\t-profile {File} -latency {Latency}\n"
+                + "\tpython3 img2mhd.py -out {Folder} -shard Finalize\n"
+                + "\tpython3 img2mhd.py -batch {Manifest} -out {Folder} -jobs {Number}\n\n\n"
+                + "Image type:\t\t{JPG/JPEG | BMP/DIB | XBM/XPM | PPM/PBM/PGM/PNM | PNG | EPS | IM | TGA | WEBP | FPX | PCD | PIXAR | PSD | TIFF/TIF | GIF | NPY | RAW}\n"
                 + "\t\t\t=> Default: PNG\n\n"
                 + "Input series:\t\t{MRA | DSA}\n"
                 + "\t\t\t=> Default: MRA\n\n"
-                + "Input files:\t\t{Single image | Folder containing SORTED images}\n\n"
+                + "Input files:\t\t{Single image | Multi-frame TIFF/GIF | Volume NPY/RAW | Folder containing SORTED images}\n\n"
                 + "Meta information:\tMeta.json\n\n"
                 + "Output files:\t\t{Output filename | Output folder}\n"
                 + "\t\t\t=> Default: Current Directory\n\n"
-                + "Output RAW iamges:\t{Simple | Multiple}\n"
+                + "Output RAW iamges:\t{Simple | Multiple | Inplace (volume input only)}\n"
                 + "\t\t\t=> Default: Simple\n\n"
+                + "Element type:\t\t{MET_UCHAR | MET_USHORT | MET_INT | MET_FLOAT | ...} (RAW volume input)\n"
+                + "\t\t\t{Auto} (smallest lossless type, image input)\n"
+                + "\t\t\t{MET_UCHAR | ...} (target type of intensity window, image input)\n\n"
+                + "Slice range:\t\t{First:Last} (positions of sorted slices, Last excluded)\n"
+                + "\t\t\t=> Default: All slices\n\n"
+                + "Crop box:\t\t{X,Y,Width,Height} (pixels)\n"
+                + "\t\t\t=> Default: Whole slice\n\n"
+                + "Watch folder:\t\t{False | Seconds without new slice until finished} (Simple RAW output only)\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Pyramid levels:\t\t{False | True (2,4,8) | Downsampling factors (comma separated)}\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Number of jobs:\t\t{Number of parallel workers}\n"
+                + "\t\t\t=> Default: 1\n\n"
+                + "Incremental cache:\t{True | False}\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Compressed RAW:\t\t{True | False}\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Directory index:\t{True | False}\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Volume statistics:\t{True | False}\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Intensity window:\t{Low,High} (percentiles, clipped and rescaled to element type)\n"
+                + "\t\t\t=> Default: None\n\n"
+                + "Target orientation:\t{RAI | LPS | ...} (voxels reoriented, Simple RAW output only)\n"
+                + "\t\t\t=> Default: None (as given in Meta.json)\n\n"
+                + "Label mask:\t\t{True | False} (masks paired by slice number, output_mask.mhd)\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Shard:\t\t\t{I/N | First:Last | Finalize} (one process of many, Simple RAW output only)\n"
+                + "\t\t\t=> Default: None (whole volume)\n\n"
+                + "Memory budget:\t\t{MiB} (slices read ahead and written behind, slow or networked storage)\n"
+                + "\t\t\t=> Default: None (read and written by the workers)\n\n"
+                + "Color conversion:\t{Luminance | Vector | R | G | B | A | ...} (color/ palette slices)\n"
+                + "\t\t\t=> Default: Vector (palette indices kept)\n\n"
+                + "Profile report:\t\t{Profile.json}\n"
+                + "\t\t\t=> Default: None\n\n"
+                + "Slice latencies:\t{True | False} (percentiles in profile report)\n"
+                + "\t\t\t=> Default: False\n\n"
+                + "Batch manifest:\t\t{Manifest.json | Manifest.csv}\n"
+                + "\t\t\t=> Report written to output folder\n\n"
                 + "For more information on different parameters use:\n"
-                + "\tpython3 img2mhd.py -h {type | series | in | meta | out | raw}\n")
+                + "\tpython3 img2mhd.py -h {type | series | in | meta | out | raw | element | range | crop | pyramid | watch | jobs | index | stats | window | orient | mask | shard | max-memory | color | cache | compress | profile | batch}\n")
     else:
         raise Exception
 
@@ -127,7 +256,7 @@ def validateParameters(args):
 
     try:
         index = args.index("-raw")
-        out_raw = args[index+1]
+        out_raw = args[index+1].capitalize()
 
         del args[index+1]
         del args[index]
@@ -145,236 +274,3789 @@ def validateParameters(args):
         # No output folder given - assert current working directory
         out_path = os.getcwd()
 
+    try:
+        index = args.index("-jobs")
+        jobs = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No number of jobs given - assert serial
+        jobs = "1"
+
+    try:
+        index = args.index("-cache")
+        cache = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No info on cache given - assert no cache
+        cache = "False"
+
+    try:
+        index = args.index("-compress")
+        compress = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No info on compression given - assert uncompressed
+        compress = "False"
+
+    try:
+        index = args.index("-profile")
+        profile = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No profile report given
+        profile = None
+
+    try:
+        index = args.index("-latency")
+        latency = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No info on slice latencies given - assert none
+        latency = "False"
+
+    try:
+        index = args.index("-element")
+        element = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No element type given - taken from the input
+        element = None
+
+    try:
+        index = args.index("-pyramid")
+        pyramid = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No pyramid levels given - assert none
+        pyramid = "False"
+
+    try:
+        index = args.index("-range")
+        z_range = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No slice range given - all slices
+        z_range = None
+
+    try:
+        index = args.index("-crop")
+        crop = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No crop box given - whole slices
+        crop = None
+
+    try:
+        index = args.index("-watch")
+        watch = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No watch mode given - assert none
+        watch = "False"
+
+    try:
+        index = args.index("-index")
+        dir_index = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No info on directory index given - assert none
+        dir_index = "False"
+
+    try:
+        index = args.index("-stats")
+        stats = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No info on statistics given - assert none
+        stats = "False"
+
+    try:
+        index = args.index("-window")
+        window = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No intensity window given - values kept
+        window = None
+
+    try:
+        index = args.index("-orient")
+        orient = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No target orientation given - voxels kept in file order
+        orient = None
+
+    try:
+        index = args.index("-mask")
+        mask = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No info on masks given - assert none
+        mask = "False"
+
+    try:
+        index = args.index("-shard")
+        shard = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No shard given - whole volume converted
+        shard = None
+
+    try:
+        index = args.index("-max-memory")
+        max_memory = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No memory budget given - slices read and written by the workers
+        max_memory = None
+
+    try:
+        index = args.index("-color")
+        color = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No color conversion given - color slices written as vectors
+        color = None
+
+    # Finalizing shards only merges their markers (input and meta not read)
+    finalize = str(shard).upper() == "FINALIZE"
+
     try:
         index = args.index("-in")
         img_path = args[index+1]
+
+        del args[index+1]
+        del args[index]
     except Exception:
         # No input file/ folder given
+        if not finalize:
+            return None
+        img_path = None
+
+    try:
+        index = args.index("-meta")
+        meta_json = args[index+1]
+
+        assert bool(re.search(r'(?i)meta.json', args[index+1]))
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No Meta.json given (or using another name which is not implemented yet!)
+        if not finalize or "-meta" in args:
+            return None
+        meta_json = None
+
+    try:
+        assert len(args) == 0
+    except Exception:
+        # Too many (unknown) parameters given
+        return None
+
+    # Return everything structured
+    return {
+        "in_meta" : meta_json,
+        "in_series": img_series,
+        "in_img" :  img_path,
+        "img_type" : img_type,
+        "out_path" : out_path,
+        "out_raw" : out_raw,
+        "jobs" : jobs,
+        "cache" : cache,
+        "compress" : compress,
+        "profile" : profile,
+        "latency" : latency,
+        "element" : element,
+        "pyramid" : pyramid,
+        "range" : z_range,
+        "crop" : crop,
+        "watch" : watch,
+        "index" : dir_index,
+        "stats" : stats,
+        "window" : window,
+        "orient" : orient,
+        "mask" : mask,
+        "shard" : shard,
+        "max_memory" : max_memory,
+        "color" : color
+    }
+
+
+# ================================================================================
+#           Validates that all parameters given in batch mode are correct!
+# ================================================================================
+def validateBatchParameters(args):
+    # Assert no parameters following another without values
+    try:
+        length = len(args)
+        assert length > 1
+
+        for i in range(1, length):
+            assert (
+                args[i-1].startswith("-") and not args[i].startswith("-")
+            ) or (
+                not args[i-1].startswith("-") and args[i].startswith("-")
+            )
+    except AssertionError:
+        return None
+
+    try:
+        index = args.index("-jobs")
+        jobs = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No number of jobs given - assert serial
+        jobs = "1"
+
+    try:
+        index = args.index("-out")
+        out_path = args[index+1]
+
+        del args[index+1]
+        del args[index]
+    except Exception:
+        # No output folder given - assert current working directory
+        out_path = os.getcwd()
+
+    try:
+        index = args.index("-batch")
+        manifest = args[index+1]
+    except Exception:
+        # No manifest given
+        return None
+
+    del args[index+1]
+    del args[index]
+
+    try:
+        assert len(args) == 0
+    except Exception:
+        # Too many (unknown) parameters given
+        return None
+
+    # Return everything structured
+    return {
+        "manifest" : manifest,
+        "out_path" : out_path,
+        "jobs" : jobs
+    }
+
+
+# ================================================================================
+#   Volume input types: numpy array (.npy) and RAW volume (shape from Meta.json)
+# ================================================================================
+VOLUME_TYPES = ["NPY", "RAW"]
+
+
+# ================================================================================
+#                               Validate image type
+# ================================================================================
+def validateImageType(given):
+    given = given.upper()
+
+    # Supported types
+    if given in [
+            "BMP", "DIB",                   # BMP format
+            "XBM", "XPM",                   # X BitMap format
+            "JPG", "JPEG",                  # JPEG format
+            "PPM", "PBM", "PGM", "PNM",     # Netpbm format
+            "PNG", "EPS", "IM", "TGA", "WEBP", "FPX", "PCD", "PIXAR", "PSD",
+            "TIFF", "TIF",                  # Tagged Image File Format (one or multiple)
+            "GIF"]:                         # Graphics Interchange Format (one or multiple)
+        return True
+
+    # Volume types (see VOLUME_TYPES)
+    if given in VOLUME_TYPES:
+        return True
+
+    # Not yet supported types
+    if given in [
+            "FLIC", "FLI", "FLC"]:          # Flic Animation format
+        print(f"\nThe given format {given} is not yet supported! May come in the future!\n")
+
+    return False
+
+
+# ================================================================================
+#                       Validate given Series (MRA / DSA)
+# ================================================================================
+def validateSeries(given):
+    return given.upper() in ["DSA", "MRA"]
+
+
+# ================================================================================
+#                   Validate RAW output (SIMPLE / MULTIPLE)
+# ================================================================================
+def validateRAW(given):
+    return given.upper() in ["SIMPLE", "MULTIPLE", "INPLACE"]
+
+
+# ================================================================================
+#               Validate number of jobs (positive integer) and return it
+# ================================================================================
+def validateJobs(given):
+    try:
+        jobs = int(given)
+    except ValueError:
+        return None
+
+    return jobs if jobs > 0 else None
+
+
+# ================================================================================
+#                   Validate a switch (TRUE / FALSE) and return it
+# ================================================================================
+def validateSwitch(given):
+    given = str(given).upper()
+
+    if given in ["TRUE", "FALSE"]:
+        return given == "TRUE"
+
+    return None
+
+
+# ================================================================================
+#       Validate pyramid levels (TRUE / FALSE / comma separated factors)
+#
+#   Returns the sorted downsampling factors (empty if none) or None if incorrect.
+# ================================================================================
+def validatePyramid(given):
+    given = str(given).upper()
+
+    if given in ["TRUE", "FALSE"]:
+        return [2, 4, 8] if given == "TRUE" else []
+
+    try:
+        factors = sorted(set(int(factor) for factor in given.split(",")))
+    except ValueError:
         return None
 
-    del args[index+1]
-    del args[index]
+    return factors if factors[0] > 1 else None
+
+
+# ================================================================================
+#       Validate watch mode (FALSE / seconds without new slice until finished)
+#
+#   Returns the seconds (0 if not watching) or None if incorrect.
+# ================================================================================
+def validateWatch(given):
+    if str(given).upper() == "FALSE":
+        return 0
+
+    try:
+        seconds = float(given)
+    except ValueError:
+        return None
+
+    return seconds if seconds > 0 else None
+
+
+# ================================================================================
+#       Validate intensity window (Low,High percentiles)
+#
+#   Returns (low, high) or None if incorrect.
+# ================================================================================
+def validateWindow(given):
+    try:
+        low, high = (float(value) for value in str(given).split(","))
+    except ValueError:
+        return None
+
+    return (low, high) if 0 <= low < high <= 100 else None
+
+
+# ================================================================================
+#       Validate slice range (First:Last, Last excluded, both optional)
+#
+#   Returns (first, last) with last None if open or None if incorrect.
+# ================================================================================
+def validateRange(given):
+    try:
+        first, last = str(given).split(":")
+        first = int(first) if first.strip() != "" else 0
+        last = int(last) if last.strip() != "" else None
+    except ValueError:
+        return None
+
+    if first < 0 or (last is not None and last <= first):
+        return None
+
+    return first, last
+
+
+# ================================================================================
+#       Validate crop box (X,Y,Width,Height in pixels)
+#
+#   Returns (x, y, width, height) or None if incorrect.
+# ================================================================================
+def validateCrop(given):
+    try:
+        box = tuple(int(value) for value in str(given).split(","))
+    except ValueError:
+        return None
+
+    if len(box) != 4 or box[0] < 0 or box[1] < 0 or box[2] <= 0 or box[3] <= 0:
+        return None
+
+    return box
+
+
+# ================================================================================
+#       Validate shard (I/N, First:Last or Finalize)
+#
+#   Returns ("PART", (i, n)) for shard i (counted from 0) of n, ("RANGE",
+#   (first, last)) for a slice range (see validateRange), ("FINALIZE", None) or
+#   None if incorrect.
+# ================================================================================
+def validateShard(given):
+    given = str(given)
+    if given.upper() == "FINALIZE":
+        return ("FINALIZE", None)
+
+    if ":" in given:
+        z_range = validateRange(given)
+        return None if z_range is None else ("RANGE", z_range)
+
+    try:
+        part, parts = (int(value) for value in given.split("/"))
+    except ValueError:
+        return None
+
+    return ("PART", (part, parts)) if 0 <= part < parts else None
+
+
+# ================================================================================
+#       Validate color conversion (Luminance, Vector or the name of a band)
+#
+#   Returns the conversion in upper case or None if incorrect. Whether the band
+#   exists is validated against the image mode (see readHeader).
+# ================================================================================
+def validateColor(given):
+    given = str(given).upper()
+
+    return given if given.isalpha() and 0 < len(given) <= 9 else None
+
+
+# ================================================================================
+#       Validate memory budget (MiB) of reading ahead and writing behind
+#
+#   Returns the budget in bytes or None if incorrect.
+# ================================================================================
+def validateMemory(given):
+    try:
+        budget = float(given)
+    except ValueError:
+        return None
+
+    return int(budget * (1 << 20)) if budget > 0 else None
+
+
+# ================================================================================
+#       Scans the image input (single file or folder) for slices of given type
+#
+#   The folder is read once (os.scandir, no stat per file), every name is matched
+#   by precompiled patterns for its extension ("type") and number ([…].N.xyz) and
+#   sorted by that number. Gaps and duplicates in the numbering are found in the
+#   same pass. Mask files are left out of the slices, numbered ones are sorted
+#   on their own ("masks", see readHeader).
+#
+#   If an index path is given, a stored result is reused as long as the
+#   modification time of the folder (changed by adding, removing or renaming
+#   files) stays the same. A new result is only stored by writeIndex (once the
+#   slices are validated).
+#
+#   Returns a dict with the sorted "files", files without number ("unnumbered"),
+#   missing numbers ("gaps"), numbers given more than once ("duplicates"), the
+#   sorted mask files ("masks") and the directory index to store ("index", None
+#   if reused or not to be kept).
+# ================================================================================
+SLICE_NUMBER = re.compile(r"(?:^|\.)([0-9]+)\.[^.]*$")
+
+def scanImages(path, img_type, index = None):
+    extension = re.compile(img_type, re.IGNORECASE)
+    scan = {"files" : [], "unnumbered" : [], "gaps" : [], "duplicates" : [], "masks" : [], "index" : None}
+
+    if os.path.isfile(path):
+        # Check if file name ("type") equals given type
+        if extension.search(path.split(".")[-1]):
+            scan["files"].append(path)
+        return scan
+
+    if not os.path.isdir(path):
+        return scan
+
+    #   Reuse directory index (if folder unchanged)
+    #   ===========================================
+    folder = os.path.abspath(path)
+    mtime = os.stat(folder).st_mtime_ns
+    if index is not None and os.path.isfile(index):
+        try:
+            with open(index, "r") as in_file:
+                cached = json.load(in_file)
+
+            if (cached["folder"], cached["mtime"], cached["type"]) == (folder, mtime, img_type):
+                for key in ["files", "unnumbered", "gaps", "duplicates", "masks"]:
+                    scan[key] = [os.path.join(path, name) for name in cached[key]] if key in ["files", "unnumbered", "masks"] else cached[key]
+                return scan
+        except Exception:
+            # Unreadable index, scanned again
+            pass
+
+
+    #   Scan folder
+    #   ===========
+    numbered, masks = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+
+            # Check if file name ("type") equals given type
+            if not extension.search(entry.name.split(".")[-1]):
+                continue
+
+            match = SLICE_NUMBER.search(entry.name)
+            if "mask" in entry.name:
+                # Mask files are kept apart (only numbered ones can be paired)
+                if match is not None:
+                    masks.append((int(match.group(1)), entry.name))
+            elif match is None:
+                scan["unnumbered"].append(entry.name)
+            else:
+                numbered.append((int(match.group(1)), entry.name))
+
+    numbered.sort()
+    for i in range(1, len(numbered)):
+        if numbered[i][0] == numbered[i-1][0]:
+            if numbered[i][0] not in scan["duplicates"]:
+                scan["duplicates"].append(numbered[i][0])
+        else:
+            scan["gaps"].extend(range(numbered[i-1][0] + 1, numbered[i][0]))
+
+    scan["files"] = [name for _, name in numbered]
+    scan["masks"] = [name for _, name in sorted(masks)]
+
+    # Not stored if the folder may still change within its timestamp resolution
+    if index is not None and time.time_ns() - mtime > 2 * 10**9:
+        content = {key : value for key, value in scan.items() if key != "index"}
+        scan["index"] = (index, dict(content, folder = folder, mtime = mtime, type = img_type))
+
+    for key in ["files", "unnumbered", "masks"]:
+        scan[key] = [os.path.join(path, name) for name in scan[key]]
+
+    return scan
+
+
+# ================================================================================
+#           Stores the directory index of a scan (see scanImages) if given
+# ================================================================================
+def writeIndex(scan):
+    if scan["index"] is None:
+        return
+
+    index, content = scan["index"]
+    os.makedirs(os.path.dirname(index) or ".", exist_ok=True)
+
+    # Replaced at once, processes sharing the output folder (shards) never see a partial index
+    temporary = f"{index}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as out_file:
+        json.dump(content, out_file)
+    os.replace(temporary, index)
+
+
+# ================================================================================
+#                   Check if Meta.json is formatted correctly
+#
+#   File should include MRA field, looking sth. like this:
+#   "MRA" : {
+#       "rows" : Int
+#       "columns" : Int
+#       "number of slices" : Int => should equal number of given images!
+#       "slice thickness" : Float
+#       "slice spacing" : Float
+#       "pixel spacing" : [Float, Float]
+#       "anatomical orientation" : String"
+#   }
+# ================================================================================
+def validateMeta(path):
+    with open(path, "r") as in_file:
+        data = json.load(in_file)
+
+    cols = rows = pxl_size = pxl_space_x = pxl_space_y = pxl_space_z = ana_ori = None
+
+    # Check if there is a MRA field in JSON
+    found = getFieldName("mra", data)
+    if found != None:
+        data = data[found]
+
+        found = [
+            getFieldName("columns", data),
+            getFieldName("rows", data),
+            getFieldName("slice thickness", data),
+            getFieldName("pixel spacing", data),
+            getFieldName("slice spacing", data),
+            getFieldName("anatomical orientation", data)
+        ]
+
+        # Columns (no default value)
+        if found[0] != None:
+            cols = data[found[0]]
+
+        # Rows (no default value)
+        if found[1] != None:
+            rows = data[found[1]]
+
+        # Pixel size
+        if found[2] != None:
+            pxl_size = data[found[2]]
+        else:
+            # Default: 1
+            pxl_size = 1
+
+        # Pixel space x/y
+        # TODO: handle list length != 2
+        if found[3] != None:
+            pxl_space_x = data[found[3]][0]
+            pxl_space_y = data[found[3]][1]
+        else:
+            # Default: 1/1
+            pxl_space_x = 1
+            pxl_space_y = 1
+
+        # Pixel space z
+        if found[4] != None:
+            pxl_space_z = data[found[4]]
+        else:
+            # Default: 1
+            pxl_space_z = 1
+
+        # Anatomical Orientation
+        if found[5] != None:
+            ana_ori = data[found[5]]
+        else:
+            # Default: RAI
+            ana_ori = "RAI"
+
+    return cols, rows, pxl_size, pxl_space_x, pxl_space_y, pxl_space_z, ana_ori
+
+
+# ================================================================================
+#               Checks if the anatomical orientation is correct
+#
+#   Anatomical orientation should look like this: [R|L][A|P][S|I]
+#   - R (right) / L (left)
+#   - A (anterior) / P (posterior)
+#   - S (superior) / I (inferior)
+# ================================================================================
+def validateAnatomicalOrientation(given):
+    if len(given) != 3:
+        # Anatomical orientation is wrongly formatted
+        return None
+
+    given = given.upper()
+
+    if "R" in given:        r = True
+    else:
+        if "L" in given:    r = False
+        else:
+            # neather "R" nor "L" found
+            return None
+
+    if "A" in given:        a = True
+    else:
+        if "P" in given:    a = False
+        else:
+            # neather "A" nor "P" found
+            return None
+
+    if "S" in given:        s = True
+    else:
+        if "I" in given:    s = False
+        else:
+            # neather "S" nor "S" found
+            return None
+
+    # Rebuild the given string (so it works on Slicer)
+    return ("R" if r else "L") + ("A" if a else "P") + ("S" if s else "I")
+
+
+# ================================================================================
+#       Checks if the orientation code names one direction of every axis
+#
+#   Unlike validateAnatomicalOrientation the order is kept, the letter at
+#   position k is the direction of axis k (X, Y, Z), e.g. "PIR" or "RAI".
+#   Returns the code in upper case or None if incorrect.
+# ================================================================================
+ORIENTATION_PAIRS = ["RL", "AP", "SI"]
+
+def validateOrientationCode(given):
+    given = str(given).upper()
+    if len(given) != 3:
+        return None
+
+    for pair in ORIENTATION_PAIRS:
+        if sum(given.count(letter) for letter in pair) != 1:
+            # no or both directions of this axis given
+            return None
+
+    return given
+
+
+# ================================================================================
+#       Applies the function to every item, on the worker pool if one is given
+#
+#   Items may finish in any order, the results are returned in the given order.
+# ================================================================================
+def mapSlices(pool, function, items):
+    if pool is None:
+        return list(map(function, items))
+
+    return list(pool.map(function, items))
+
+
+# ================================================================================
+#   Applies the function to every item like mapSlices, but yields the results one
+#   after another in the given order. At most twice as many items as jobs (the
+#   workers of the pool) are processed at once (and held in memory), the pool
+#   keeps working while results are consumed.
+# ================================================================================
+def streamSlices(pool, function, items, jobs = 1):
+    if pool is None:
+        yield from map(function, items)
+        return
+
+    window = 2 * jobs
+    pending = collections.deque()
+
+    for item in items:
+        if len(pending) == window:
+            yield pending.popleft().result()
+        pending.append(pool.submit(function, item))
+
+    while len(pending) != 0:
+        yield pending.popleft().result()
+
+
+# ================================================================================
+#       Returns the I/O counters of this process (Linux only, else None)
+# ================================================================================
+def getIOCounters():
+    try:
+        with open("/proc/self/io", "r") as in_file:
+            counters = dict(line.split(": ") for line in in_file.read().splitlines())
+
+        return int(counters["rchar"]), int(counters["wchar"])
+    except Exception:
+        return None
+
+
+# ================================================================================
+#       Returns the peak resident memory of this process so far (in bytes)
+# ================================================================================
+def getPeakRSS():
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # Linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# ================================================================================
+#       Resets the peak resident memory of this process to the current one
+#
+#   Only possible on Linux (/proc/self/clear_refs), returns False otherwise. The
+#   peak since the reset is given by getStagePeakRSS, getPeakRSS is not reset.
+# ================================================================================
+def resetPeakRSS():
+    try:
+        with open("/proc/self/clear_refs", "w") as out_file:
+            out_file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# ================================================================================
+#   Returns the peak resident memory since the last reset (in bytes, see above)
+# ================================================================================
+def getStagePeakRSS():
+    try:
+        with open("/proc/self/status", "r") as in_file:
+            for line in in_file:
+                if line.startswith("VmHWM:"):
+                    # Given in kilobytes
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+# ================================================================================
+#       Records wall/ CPU time, bytes read/ written and peak memory per stage
+#
+#   Bytes are taken from the read/ write calls of the process, bytes written to
+#   memory maps are added by the writers themselves (see written). Latencies of
+#   every slice are only recorded if asked for.
+#
+#   The peak memory of a stage is reset at its start where possible (Linux, see
+#   resetPeakRSS), otherwise it is the peak of the process up to its end. It is
+#   the memory of the whole process, so stages of series converted at the same
+#   time (see convertBatch) share it. The total is the peak of the process.
+# ================================================================================
+class Profile:
+    def __init__(self, latency = False):
+        self.stages = {}
+        self.latencies = [] if latency else None
+        self.mapped = 0
+        self.peaks = []                                         # peak memory of every running stage ([bytes])
+        self.peaks_lock = threading.Lock()
+
+    # Keeps the peak memory since the last reset in every running stage
+    def peak(self, reset = False):
+        with self.peaks_lock:
+            peak = getStagePeakRSS() or 0
+            for running in self.peaks:
+                running[0] = max(running[0], peak)
+
+            if reset:
+                resetPeakRSS()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        running = [0]
+        self.peak(reset=True)
+        with self.peaks_lock:
+            self.peaks.append(running)
+
+        start, cpu, io, mapped = time.perf_counter(), time.process_time(), getIOCounters(), self.mapped
+
+        try:
+            yield
+        finally:
+            end = getIOCounters()
+            stage = self.stages.setdefault(name, {"wall" : 0, "cpu" : 0, "bytes_read" : 0, "bytes_written" : 0})
+
+            stage["wall"] += time.perf_counter() - start
+            stage["cpu"] += time.process_time() - cpu
+            if io is not None and end is not None:
+                stage["bytes_read"] += end[0] - io[0]
+                stage["bytes_written"] += end[1] - io[1]
+            stage["bytes_written"] += self.mapped - mapped
+
+            self.peak()
+            with self.peaks_lock:
+                self.peaks = [peak for peak in self.peaks if peak is not running]
+            stage["peak_rss"] = max(stage.get("peak_rss", 0), running[0] or getPeakRSS() or 0)
+
+    # Bytes written without a write call (memory maps)
+    def written(self, size):
+        self.mapped += size
+
+    # Returns the report (stages + slice latency percentiles) as dict
+    def report(self):
+        report = {"stages" : self.stages}
+        report["total"] = {
+            key : sum(stage[key] for stage in self.stages.values())
+            for key in ["wall", "cpu", "bytes_read", "bytes_written"]
+        }
+        report["total"]["peak_rss"] = max([getPeakRSS() or 0] + [stage["peak_rss"] for stage in self.stages.values()])
+
+        if self.latencies is not None and len(self.latencies) != 0:
+            latencies = sorted(self.latencies)
+            report["slices"] = {"count" : len(latencies), "mean" : sum(latencies) / len(latencies)}
+
+            for percentile in [50, 90, 95, 99, 100]:
+                # Nearest rank
+                rank = max(1, -(-percentile * len(latencies) // 100))
+                report["slices"][f"p{percentile}"] = latencies[rank - 1]
+
+        return report
+
+
+# ================================================================================
+#           Returns the context of a profile stage (nothing without profile)
+# ================================================================================
+def profileStage(profile, name):
+    return contextlib.nullcontext() if profile is None else profile.stage(name)
+
+
+# ================================================================================
+#   Returns the function measuring its latency per slice (if profile asks for it)
+# ================================================================================
+def profileSlices(profile, function):
+    if profile is None or profile.latencies is None:
+        return function
+
+    def timed(item):
+        start = time.perf_counter()
+        result = function(item)
+        profile.latencies.append(time.perf_counter() - start)
+        return result
+
+    return timed
+
+
+# ================================================================================
+#       Slices are given as file path or (file path, frame) for every frame of
+#       a multi-frame file (TIFF/ GIF)
+# ================================================================================
+def isFrame(source):
+    return isinstance(source, tuple)
+
+
+# ================================================================================
+#   Returns the number of a slice file ([…].N.xyz), raises a ValueError if none
+# ================================================================================
+def getSliceNumber(file):
+    match = SLICE_NUMBER.search(file.split(os.path.sep)[-1])
+    if match is None:
+        raise ValueError(f"Slice is not numbered: {file}")
+
+    return int(match.group(1))
+
+
+# ================================================================================
+#       Returns the name of a slice (file name without extension [+ frame])
+# ================================================================================
+def getSliceName(source):
+    if isFrame(source):
+        return os.path.splitext(source[0].split(os.path.sep)[-1])[0] + "." + str(source[1])
+
+    return os.path.splitext(source.split(os.path.sep)[-1])[0]
+
+
+# ================================================================================
+#           Returns the number of frames of an image file (1 if not readable)
+# ================================================================================
+def countFrames(file):
+    from PIL import Image
+
+    try:
+        with Image.open(file) as im:
+            return getattr(im, "n_frames", 1)
+    except Exception:
+        return 1
+
+
+# ================================================================================
+#           Reads the header of an image only (pixel data is not decoded)
+#
+#   Returns (size, mode, format, number of channels) or None if not readable.
+# ================================================================================
+def readImageHeader(file):
+    from PIL import Image
+
+    try:
+        with Image.open(file) as im:
+            return im.size, im.mode, im.format, len(im.getbands())
+    except Exception:
+        return None
+
+
+# ================================================================================
+#       Reads the headers of the given frames of a multi-frame file in one pass
+#
+#   TIFF frames are only seeked (reading their IFD, not their pixel data). GIF
+#   frames can not be seeked without decoding: they keep the palette indices if
+#   all frames of the file share the palette of the first one, otherwise all are
+#   read as RGB(A) (see openFrame). All frames are checked, so every slice range
+#   or shard reads them the same way. Returns the headers in the order of the
+#   given frames (all frames if none given).
+# ================================================================================
+def readFrameHeaders(file, frames = None):
+    from PIL import Image
+
+    with Image.open(file) as im:
+        frames = range(0, im.n_frames) if frames is None else frames
+        if im.format == "GIF":
+            modes = set()
+            with keepPalettes():
+                for frame in range(0, im.n_frames):
+                    im.seek(frame)
+                    modes.add(im.mode)
+
+            mode = modes.pop() if len(modes) == 1 else ("RGBA" if "RGBA" in modes else "RGB")
+            gif_modes[file] = mode
+            return [(im.size, mode, im.format, Image.getmodebands(mode))] * len(frames)
+
+        headers = []
+        for frame in frames:
+            im.seek(frame)
+            headers.append((im.size, im.mode, im.format, len(im.getbands())))
+
+        return headers
+
+
+# ================================================================================
+#       Checks if all images match the first one in size, mode and format
+#
+#   Only image headers are read (in parallel if a pool is given). Returns the
+#   header of the first image and a list of all files which differ from it.
+# ================================================================================
+def validateConsistency(files, pool = None):
+    if isFrame(files[0]):
+        try:
+            # Only the frames within the slice range
+            headers = readFrameHeaders(files[0][0], [frame for _, frame in files])
+        except Exception:
+            headers = [None] * len(files)
+    else:
+        headers = mapSlices(pool, readImageHeader, files)
+
+    differ = [
+        files[i] for i in range(0, len(files))
+        if headers[i] is None or headers[i] != headers[0]
+    ]
+
+    return headers[0], differ
+
+
+# ================================================================================
+#               Returns the content hash of the given (slice) file data
+# ================================================================================
+def hashSlice(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# ================================================================================
+#       Reads the files of slices ahead of decoding (slow or networked storage)
+#
+#   Reader threads read the files in the given order (the order they are decoded
+#   in), while the bytes read but not taken yet stay within max_memory (plus one
+#   file per reader). openSlice takes the bytes of a registered file (waiting
+#   until read) instead of reading it, so decoding overlaps with reading.
+#   Registered while used as context, a file is taken once.
+# ================================================================================
+class Prefetch:
+    registry = {}                                               # file -> Prefetch (of every conversion)
+    registry_lock = threading.Lock()
+
+    def __init__(self, files, max_memory, readers = 4):
+        self.files = [file for file in files if not isFrame(file)]
+        self.max_memory = max_memory
+        self.data = {}                                          # file -> bytes read (not taken yet)
+        self.held = 0
+        self.next = 0                                           # position of the next file to read
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.read, daemon=True) for _ in range(0, readers)]
+
+    def __enter__(self):
+        with Prefetch.registry_lock:
+            for file in self.files:
+                Prefetch.registry[file] = self
+
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    # Stops reading, files not taken yet are read by openSlice again
+    def __exit__(self, *exc):
+        with self.condition:
+            self.closed = True
+            self.data.clear()
+            self.condition.notify_all()
+
+        with Prefetch.registry_lock:
+            for file in self.files:
+                if Prefetch.registry.get(file) is self:
+                    del Prefetch.registry[file]
+
+        for thread in self.threads:
+            thread.join()
+
+    # Reads the next file as long as the bytes held are within the budget
+    def read(self):
+        while True:
+            with self.condition:
+                while not self.closed and self.next < len(self.files) and self.held >= self.max_memory:
+                    self.condition.wait()
+
+                if self.closed or self.next == len(self.files):
+                    return
+
+                file = self.files[self.next]
+                self.next += 1
+
+            try:
+                with open(file, "rb") as in_file:
+                    data = in_file.read()
+            except OSError:
+                # Read again by openSlice (raising the error there)
+                data = None
+
+            with self.condition:
+                if not self.closed:
+                    self.data[file] = data
+                    self.held += len(data or b"")
+                self.condition.notify_all()
+
+    # Returns the bytes of the file (None if not registered or not readable)
+    @staticmethod
+    def take(file):
+        with Prefetch.registry_lock:
+            prefetch = Prefetch.registry.pop(file, None)
+        if prefetch is None:
+            return None
+
+        with prefetch.condition:
+            while file not in prefetch.data and not prefetch.closed:
+                prefetch.condition.wait()
+
+            data = prefetch.data.pop(file, None)
+            prefetch.held -= len(data or b"")
+            prefetch.condition.notify_all()
+
+        return data
+
+
+# ================================================================================
+#       Writes files behind the workers (one writer thread, bounded queue)
+#
+#   Workers pass the path and data and continue decoding, while the bytes queued
+#   stay within max_memory (plus one file). The first error while writing is
+#   raised by close, after every file queued was tried.
+# ================================================================================
+class WriteBehind:
+    def __init__(self, max_memory, profile = None):
+        self.max_memory = max_memory
+        self.profile = profile
+        self.queue = collections.deque()
+        self.held = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    # Queues the data to be written to path (waiting while the queue is full)
+    def submit(self, path, data):
+        size = memoryview(data).nbytes
+
+        with self.condition:
+            while self.held != 0 and self.held + size > self.max_memory:
+                self.condition.wait()
+
+            self.queue.append((path, data))
+            self.held += size
+            self.condition.notify_all()
+
+    # Writer thread: every file by one unbuffered write (see writeRAWMultiple)
+    def write(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.closed:
+                    self.condition.wait()
+
+                if len(self.queue) == 0:
+                    return
+                path, data = self.queue[0]
+
+            try:
+                with open(path, "wb", buffering=0) as raw:
+                    rest = memoryview(data).cast("B")
+                    while len(rest) != 0:
+                        rest = rest[raw.write(rest):]
+            except OSError as error:
+                self.error = self.error or error
+
+            with self.condition:
+                self.queue.popleft()
+                self.held -= memoryview(data).nbytes
+                self.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Waits for every file queued to be written
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+
+# ================================================================================
+#   Reads a slice once, returns the opened image and its content hash (if asked)
+#
+#   The bytes are taken from the prefetch (see Prefetch) if it read the file.
+# ================================================================================
+def openSlice(file, digest = False):
+    from PIL import Image
+
+    if isFrame(file):
+        return openFrame(*file), None
+
+    data = Prefetch.take(file)
+    if data is None:
+        with open(file, "rb") as in_file:
+            data = in_file.read()
+
+    return Image.open(io.BytesIO(data)), (hashSlice(data) if digest else None)
+
+
+# ================================================================================
+#   Decodes a slice (cropped to (x, y, width, height) if given) to a numpy array
+#
+#   Returns the array and the content hash of the file (if asked for). Without
+#   hash (or prefetch), uncompressed slices are cropped before decoding (see
+#   readRegion).
+# ================================================================================
+def loadSlice(file, digest = False, crop = None, color = None):
+    import numpy
+
+    if crop is not None and not digest and not isFrame(file) and file not in Prefetch.registry:
+        region = readRegion(file, crop)
+        if region is not None:
+            return region, None
+
+    def toArray(im):
+        if color is None:
+            return numpy.asarray(im)
+
+        return toScalar(numpy.asarray(im), im.mode, color, im.getpalette() if im.mode in ["P", "PA"] else None)
+
+    im, hashed = openSlice(file, digest)
+    with im:
+        if crop is None:
+            return toArray(im), hashed
+
+        with im.crop((crop[0], crop[1], crop[0] + crop[2], crop[1] + crop[3])) as region:
+            return toArray(region), hashed
+
+
+# ================================================================================
+#       Returns the names of the bands of the image mode (PIL) in upper case
+# ================================================================================
+def getColorBands(mode):
+    from PIL import ImageMode
+
+    return [band.upper() for band in ImageMode.getmode(mode).bands]
+
+
+# ================================================================================
+#       Converts color (or palette) pixels to one scalar per pixel (vectorized)
+#
+#   Applied to one slice at a time by the worker that decoded it (see loadSlice),
+#   as every slice may have a palette of its own. LUMINANCE is ITU-R 601-2 luma
+#   as computed by PIL (convert("L")), palette indices are looked up in the luma
+#   of the palette, otherwise the band of the given name (e.g. "R") is selected.
+# ================================================================================
+def toScalar(data, mode, color, palette = None):
+    import numpy
+
+    bands = getColorBands(mode)
+    if len(bands) == 1:
+        data = data[..., None]
+
+    if color != "LUMINANCE":
+        return data[..., bands.index(color)]
+
+    if bands[0] == "P":
+        values = (palette or [])[:768]
+        colors = numpy.zeros(768, dtype=numpy.uint8)
+        colors[:len(values)] = values
+        return toScalar(colors.reshape(256, 3), "RGB", "LUMINANCE")[data[..., 0]]
+
+    if bands[0] == "L":
+        return data[..., 0]
+
+    rgb = data[..., :3].astype(numpy.uint32)
+    return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(numpy.uint8)
+
+
+# ================================================================================
+#       Reads the crop box of an uncompressed slice without decoding the rest
+#
+#   Slices stored as one raw block (BMP, IM, PGM, uncompressed TIFF, ...) are
+#   memory-mapped, so only the rows of the box are read from disk. Returns None
+#   if the slice is stored otherwise (compressed, palette, ...).
+# ================================================================================
+RAW_MODES = {
+    "L" : "u1",
+    "I;16" : "<u2",
+    "I;16L" : "<u2",
+    "I;16B" : ">u2",
+    "I;32" : "<i4",
+    "I;32B" : ">i4",
+    "F;32F" : "<f4",
+    "F;32BF" : ">f4"
+}
+
+def readRegion(file, crop):
+    import numpy
+    from PIL import Image
+
+    with Image.open(file) as im:
+        width, height = im.size
+        if len(im.tile) != 1 or im.tile[0][0] != "raw" or tuple(im.tile[0][1]) != (0, 0, width, height):
+            return None
+
+        offset, args = im.tile[0][2], im.tile[0][3]
+
+    # Arguments of the raw decoder: rawmode [, stride [, orientation]]
+    args = (args,) if isinstance(args, str) else tuple(args)
+    if args[0] not in RAW_MODES:
+        return None
+
+    dtype = numpy.dtype(RAW_MODES[args[0]])
+    stride = args[1] if len(args) > 1 and args[1] else width * dtype.itemsize
+    orientation = args[2] if len(args) > 2 else 1
+
+    if stride % dtype.itemsize != 0 or offset + stride * height > os.path.getsize(file):
+        return None
+
+    rows = numpy.memmap(file, dtype=dtype, mode="r", offset=offset, shape=(height, stride // dtype.itemsize))
+    x, y, columns, lines = crop
+
+    if orientation < 0:
+        # Stored bottom-up
+        region = rows[height - y - lines:height - y][::-1, x:x + columns]
+    else:
+        region = rows[y:y + lines, x:x + columns]
+
+    return numpy.array(region)
+
+
+# ================================================================================
+#       Reads one frame of a multi-frame file (copied, as the file stays open)
+#
+#   The file is kept open between calls, so reading frames one after another only
+#   seeks forward instead of starting over (GIF frames even need to be decoded
+#   in order). Frames are therefore read by one thread only (see closeFrames).
+#   GIF frames are read in the mode found by readFrameHeaders, so they keep the
+#   palette indices like single GIF files, unless their palettes differ.
+# ================================================================================
+frame_readers = threading.local()
+
+def openFrame(file, frame):
+    from PIL import Image
+
+    reader = getattr(frame_readers, "reader", None)
+    if reader is None or reader.filename != file or reader.tell() > frame:
+        closeFrames()
+        reader = frame_readers.reader = Image.open(file)
+
+    if reader.format != "GIF":
+        reader.seek(frame)
+        return reader.copy()
+
+    with keepPalettes():
+        reader.seek(frame)
+        mode = gif_modes.get(file, reader.mode)
+        return reader.copy() if reader.mode == mode else reader.convert(mode)
+
+
+# ================================================================================
+#       Reads GIF frames with the palette kept, as long as it does not change
+#
+#   By default PIL reads all GIF frames after the first one as RGB(A). The
+#   loading strategy is global to PIL, so it is only changed while the lock is
+#   held.
+# ================================================================================
+gif_modes = {}
+gif_lock = threading.Lock()
+
+@contextlib.contextmanager
+def keepPalettes():
+    from PIL import GifImagePlugin
+
+    with gif_lock:
+        strategy = GifImagePlugin.LOADING_STRATEGY
+        GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+        try:
+            yield
+        finally:
+            GifImagePlugin.LOADING_STRATEGY = strategy
+
+
+# ================================================================================
+#               Closes the multi-frame file kept open by openFrame
+# ================================================================================
+def closeFrames():
+    reader = getattr(frame_readers, "reader", None)
+    if reader is not None:
+        reader.close()
+        frame_readers.reader = None
+
+
+# ================================================================================
+#       Decodes a slice into a contiguous array of the given data type
+# ================================================================================
+def decodeSlice(file, dtype, crop = None, color = None):
+    import numpy
+
+    data, _ = loadSlice(file, False, crop, color)
+    return numpy.ascontiguousarray(data, dtype=dtype)
+
+
+# ================================================================================
+#           Decodes all slices straight into the given volume (Z first)
+#
+#   If indexes are given, only those slices are decoded. Returns the content
+#   hashes of the slices decoded (if asked for).
+# ================================================================================
+def readSlices(files, volume, pool = None, indexes = None, digest = False, profile = None, observers = (), crop = None, color = None):
+    def readSlice(i):
+        # Casting to the given data type is done while assigning
+        volume[i], hashed = loadSlice(files[i], digest, crop, color)
+
+        for observer in observers:
+            observer.add(i, volume[i])
+
+        return hashed
+
+    return mapSlices(pool, profileSlices(profile, readSlice), range(0, len(files)) if indexes is None else indexes)
+
+
+# ================================================================================
+#           Writes all slices into one single (memory-mapped) RAW file
+#
+#   The final shape is known from DimSize, therefore the RAW file is created in
+#   its final size and every slice is decoded straight to its Z offset. Only one
+#   slice per worker is held in memory at a time. If indexes are given, only
+#   those slices are written into the already existing RAW file.
+#
+#   Returns the content hashes of the slices written (if asked for). Every slice
+#   is passed to the observers (pyramid, intensity range) right after decoding.
+#   With an orientation (source, target), the slices are written reoriented
+#   (see openReoriented) in the same pass.
+# ================================================================================
+def writeRAWSimple(files, path, dtype, shape, pool = None, indexes = None, digest = False, profile = None, observers = (), crop = None,
+                   color = None, orientation = None):
+    import numpy
+
+    shape = (len(files),) + tuple(shape)
+    if orientation is not None:
+        output, volume = openReoriented(path, dtype, shape, *orientation)
+    else:
+        output = volume = numpy.memmap(path, dtype=dtype, mode="w+" if indexes is None else "r+", shape=shape)
+
+    hashes = readSlices(files, volume, pool, indexes, digest, profile, observers, crop, color)
+
+    output.flush()
+    if profile is not None:
+        profile.written(volume[0].nbytes * len(hashes))
+    del output, volume
+
+    return hashes
+
+
+# ================================================================================
+#       Combines the Adler-32 checksums of two consecutive blocks of data
+#
+#   Same as adler32_combine of zlib (not exposed by Python), length is the size
+#   of the second block.
+# ================================================================================
+def combineAdler32(adler1, adler2, length):
+    base = 65521
+    rem = length % base
+
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+
+    if sum1 >= base: sum1 -= base
+    if sum1 >= base: sum1 -= base
+    if sum2 >= (base << 1): sum2 -= (base << 1)
+    if sum2 >= base: sum2 -= base
+
+    return sum1 | (sum2 << 16)
+
+
+# ================================================================================
+#           Writes all slices into one single zlib compressed RAW file
+#
+#   Every slice is decoded and compressed on its own (raw deflate, flushed to a
+#   byte boundary) in parallel if a pool is given. The chunks are then written in
+#   order between one zlib header and the combined Adler-32 checksum, resulting
+#   in a single zlib stream as read by ITK/ elastix. The volume is never held in
+#   memory as a whole.
+#
+#   Returns the size of the compressed file and the content hashes of the slices
+#   written (if asked for).
+# ================================================================================
+def writeRAWCompressed(files, path, dtype, pool = None, digest = False, profile = None, observers = (), crop = None, color = None,
+                       jobs = 1):
+    import numpy
+
+    def readSlice(i):
+        data, hashed = loadSlice(files[i], digest, crop, color)
+        data = numpy.ascontiguousarray(data, dtype=dtype)
+
+        for observer in observers:
+            observer.add(i, data)
+
+        return data, hashed
+
+    return writeZlibStream(path, readSlice, len(files), pool, profile, jobs)
+
+
+# ================================================================================
+#       Writes the chunks returned by function(0 ... count-1) as one zlib stream
+#
+#   Function returns a contiguous buffer and its content hash (or None). Every
+#   chunk is compressed on its own on the pool of the given jobs (see
+#   writeRAWCompressed). Returns the size of the compressed file and the content
+#   hashes.
+# ================================================================================
+def writeZlibStream(path, function, count, pool = None, profile = None, jobs = 1):
+    def compressSlice(i):
+        data, hashed = function(i)
+        data = memoryview(data).cast("B")
+
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        chunk = compressor.compress(data) + compressor.flush(
+            zlib.Z_FINISH if i == count - 1 else zlib.Z_FULL_FLUSH
+        )
+
+        return chunk, zlib.adler32(data), len(data), hashed
+
+    hashes = []
+    with open(path, "wb") as raw:
+        # zlib header (deflate, 32K window, default compression)
+        raw.write(b"\x78\x9c")
+        adler = 1
+
+        for chunk, chunk_adler, length, hashed in streamSlices(pool, profileSlices(profile, compressSlice), range(0, count), jobs):
+            raw.write(chunk)
+            adler = combineAdler32(adler, chunk_adler, length)
+            hashes.append(hashed)
+
+        raw.write(adler.to_bytes(4, "big"))
+        size = raw.tell()
+
+    return size, hashes
+
+
+# ================================================================================
+#               Writes every slice into its own RAW file (LIST 2D)
+#
+#   If indexes are given, only those slices are written. Slices are zlib
+#   compressed (.zraw) on their own if asked for. Returns the content hashes of
+#   the slices written (if asked for).
+#
+#   The decoded slice is written as is (buffer protocol, no copy) if it already
+#   has the given data type. Otherwise it is cast into a buffer reused by every
+#   slice of the same worker. Each file is written by one single system call,
+#   by the writer (see WriteBehind) if one is given.
+# ================================================================================
+def writeRAWMultiple(files, path, dtype, pool = None, indexes = None, digest = False, compress = False, profile = None, observers = (), crop = None,
+                     writer = None, color = None):
+    import numpy
+
+    buffers = threading.local()
+
+    def writeSlice(i):
+        file = files[i]
+        image_2d, hashed = loadSlice(file, digest, crop, color)
+
+        if image_2d.dtype != dtype or not image_2d.flags.c_contiguous:
+            buffer = getattr(buffers, "buffer", None)
+            if buffer is None or buffer.shape != image_2d.shape:
+                buffer = buffers.buffer = numpy.empty(image_2d.shape, dtype=dtype)
+
+            numpy.copyto(buffer, image_2d, casting="unsafe")
+            image_2d = buffer
+
+        for observer in observers:
+            observer.add(i, image_2d)
+
+        data = memoryview(image_2d).cast("B")
+        if compress:
+            data = zlib.compress(data)
+
+        # Unbuffered, the whole slice is passed to the system at once
+        name = getSliceName(file) + (".zraw" if compress else ".raw")
+        if writer is not None:
+            # Copied if the buffer is reused by the next slice of this worker
+            writer.submit(os.path.join(path, name), bytes(data) if image_2d is getattr(buffers, "buffer", None) and not compress else data)
+            return hashed
+
+        with open(os.path.join(path, name), "wb", buffering=0) as raw:
+            while len(data) != 0:
+                data = data[raw.write(data):]
+
+        return hashed
+
+    return mapSlices(pool, profileSlices(profile, writeSlice), range(0, len(files)) if indexes is None else indexes)
+
+
+# ================================================================================
+#       Downsampled levels (multi-resolution pyramid) written while decoding
+#
+#   Every level is a (memory-mapped) RAW file of its own, each voxel being the
+#   mean of factor^3 voxels of the full volume (remainders are cut off, as done
+#   by ITK's shrink filter). Slices are passed by add (in any order, from any
+#   worker): they are reduced in X/Y at once and summed up per Z block, a block
+#   is written as soon as all of its slices arrived. Only the incomplete blocks
+#   (one reduced slice each) are held in memory.
+# ================================================================================
+class Pyramid:
+    def __init__(self, path, header, factors, profile = None):
+        import numpy
+
+        self.path = path
+        self.header = header
+        self.profile = profile
+        self.levels = []
+        self.lock = threading.Lock()
+
+        shapes = [tuple(size // factor for size in header.shape[:3]) + header.shape[3:] for factor in factors]
+        for factor, shape in zip(factors, shapes):
+            if 0 in shape:
+                raise ConversionError(f"Volume is too small for pyramid level {factor}x!", ERR_PYRAMID)
+
+        for factor, shape in zip(factors, shapes):
+            name = f"output_{factor}x"
+            self.levels.append({
+                "factor" : factor,
+                "name" : name,
+                "shape" : shape,
+                "volume" : numpy.memmap(os.path.join(path, name + ".raw"), dtype=header.dtype, mode="w+", shape=shape),
+                "blocks" : {}
+            })
+
+    # Adds the Z-th slice of the full volume to every level
+    def add(self, z, data):
+        import numpy
+
+        for level in self.levels:
+            factor, volume = level["factor"], level["volume"]
+            if z // factor >= volume.shape[0]:
+                # Remainder, cut off
+                continue
+
+            rows, columns = volume.shape[1:3]
+            reduced = numpy.asarray(data)[:rows * factor, :columns * factor].reshape(
+                (rows, factor, columns, factor) + volume.shape[3:]
+            ).sum(axis=(1, 3), dtype=numpy.float64)
+
+            with self.lock:
+                block = level["blocks"].get(z // factor)
+                if block is None:
+                    level["blocks"][z // factor] = block = [reduced, 1]
+                else:
+                    block[0] += reduced
+                    block[1] += 1
+
+                if block[1] != factor:
+                    continue
+                del level["blocks"][z // factor]
+
+            # Block complete: mean of all factor^3 voxels
+            mean = block[0] / factor ** 3
+            if numpy.issubdtype(volume.dtype, numpy.integer):
+                numpy.rint(mean, out=mean)
+
+            volume[z // factor] = mean
+
+    # Flushes every level (memory map is released)
+    def flush(self):
+        for level in self.levels:
+            if level["volume"] is not None:
+                level["volume"].flush()
+                if self.profile is not None:
+                    self.profile.written(level["volume"].nbytes)
+
+                level["volume"] = None
+
+    # Converts every level from its data type to the given one in place (see convertRAW)
+    def convert(self, dtype, new_dtype, function = None):
+        self.flush()
+
+        for level in self.levels:
+            convertRAW(
+                os.path.join(self.path, level["name"] + ".raw"), level["shape"][0],
+                dtype, new_dtype, function, self.profile
+            )
+
+    # Flushes every level and writes its MHD header (spacing scaled by the factor)
+    def close(self):
+        self.flush()
+
+        for level in self.levels:
+            factor = level["factor"]
+
+            header = MHDHeader(
+                [], self.header.mode, self.header.channels, tuple(reversed(level["shape"][:3])),
+                self.header.element_type,
+                tuple(value * factor for value in self.header.element_size),
+                tuple(value * factor for value in self.header.element_spacing),
+                self.header.anatomical_orientation
+            )
+            header.element_data_file = level["name"] + ".raw"
+
+            # Center of the first (mean) voxel relative to the full volume
+            header.offset = tuple(
+                origin + value * (factor - 1) / 2
+                for origin, value in zip(self.header.offset or (0, 0, 0), self.header.element_spacing)
+            )
+
+            writeMHD(os.path.join(self.path, level["name"] + ".mhd"), header)
+
+
+# ================================================================================
+#       Intensity range (global minimum and maximum) gathered while decoding
+#
+#   Slices are passed by add (in any order, from any worker), only the running
+#   minimum and maximum are kept.
+# ================================================================================
+class Intensity:
+    def __init__(self):
+        self.minimum = None
+        self.maximum = None
+        self.lock = threading.Lock()
+
+    # Adds the Z-th slice (vectorized minimum/ maximum, merged under the lock)
+    def add(self, z, data):
+        import numpy
+
+        data = numpy.asarray(data)
+        minimum, maximum = data.min(), data.max()
+
+        with self.lock:
+            self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+            self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+
+# ================================================================================
+#       Volume statistics (histogram, percentiles, mean, ...) gathered while decoding
+#
+#   Every slice is counted into a histogram of 65536 buckets at most (vectorized,
+#   numpy.bincount), merged into the one of the volume under the lock. Buckets
+#   are exact values for integer types up to 16 bit, otherwise the upper 16 bits
+#   of the (order preserving) float32 representation, so percentiles of them are
+#   accurate to less than 1 % of the value.
+# ================================================================================
+class Statistics:
+    PERCENTILES = [0.5, 1, 5, 25, 50, 75, 95, 99, 99.5]
+
+    def __init__(self, dtype):
+        import numpy
+
+        self.dtype = numpy.dtype(dtype).newbyteorder("=")
+        self.exact = self.dtype.kind in "ui" and self.dtype.itemsize <= 2
+        self.counts = numpy.zeros(1 << (8 * self.dtype.itemsize if self.exact else 16), dtype=numpy.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.squares = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.lock = threading.Lock()
+
+    # Returns the (order preserving) histogram bucket of every value
+    def getBuckets(self, data):
+        import numpy
+
+        data = numpy.ascontiguousarray(data, dtype=self.dtype).reshape(-1)
+        if self.exact:
+            if self.dtype.kind == "u":
+                return data
+
+            # Signed: flip the sign bit, so negative values come first
+            return data.view("u" + str(self.dtype.itemsize)) ^ (1 << (8 * self.dtype.itemsize - 1))
+
+        bits = data.astype(numpy.float32).view(numpy.uint32)
+        return numpy.where(bits & 0x80000000, ~bits, bits | 0x80000000) >> 16
+
+    # Returns the lowest value of the given buckets
+    def getValues(self, buckets):
+        import numpy
+
+        if self.exact:
+            return buckets - (0 if self.dtype.kind == "u" else 1 << (8 * self.dtype.itemsize - 1))
+
+        bits = numpy.asarray(buckets, dtype=numpy.uint32) << 16
+        return numpy.where(bits & 0x80000000, bits & 0x7FFFFFFF, ~bits).astype(numpy.uint32).view(numpy.float32).astype(numpy.float64)
+
+    # Adds the Z-th slice (histogram, sums, minimum/ maximum)
+    def add(self, z, data):
+        import numpy
+
+        data = numpy.asarray(data)
+        counts = numpy.bincount(self.getBuckets(data), minlength=len(self.counts))
+        total, squares = data.sum(dtype=numpy.float64), numpy.square(data, dtype=numpy.float64).sum()
+        minimum, maximum = data.min(), data.max()
+
+        with self.lock:
+            self.counts += counts
+            self.count += data.size
+            self.sum += total
+            self.squares += squares
+            self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+            self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+    # Returns the value at the given percentile (nearest rank)
+    def percentile(self, percent):
+        import numpy
+
+        rank = max(1, int(numpy.ceil(percent / 100 * self.count)))
+        bucket = int(numpy.searchsorted(numpy.cumsum(self.counts), rank))
+
+        value = float(self.getValues(numpy.array([bucket]))[0])
+        return min(max(value, float(self.minimum)), float(self.maximum))
+
+    # Returns the statistics as dict (histogram of 256 bins from minimum to maximum)
+    def report(self):
+        import numpy
+
+        buckets = numpy.nonzero(self.counts)[0]
+        mean = self.sum / self.count
+        counts, edges = numpy.histogram(
+            numpy.clip(self.getValues(buckets), float(self.minimum), float(self.maximum)), bins=256, range=(float(self.minimum), float(self.maximum)), weights=self.counts[buckets]
+        )
+
+        return {
+            "count" : self.count,
+            "minimum" : self.minimum.item(),
+            "maximum" : self.maximum.item(),
+            "mean" : mean,
+            "std" : float(numpy.sqrt(max(self.squares / self.count - mean * mean, 0))),
+            "percentiles" : {str(percent) : self.percentile(percent) for percent in Statistics.PERCENTILES},
+            "histogram" : {
+                "edges" : edges.tolist(),
+                "counts" : counts.astype(numpy.int64).tolist()
+            }
+        }
+
+
+# ================================================================================
+#       Label mask (output_mask.mhd/ .raw) written while decoding the image
+#
+#   The mask paired with the Z-th slice (see readHeader) is decoded by add, on
+#   the worker which decoded the slice, and written to its Z offset as
+#   MET_UCHAR labels. The MHD header is written by close with the geometry of
+#   the image (DimSize, spacing, orientation and Offset as finally written).
+# ================================================================================
+class Mask:
+    def __init__(self, path, header, profile = None, orientation = None):
+        import numpy
+
+        self.path = path
+        self.header = header
+        self.profile = profile
+        if orientation is not None:
+            # Labels written reoriented (see openReoriented)
+            self.output, self.volume = openReoriented(
+                os.path.join(path, "output_mask.raw"), numpy.uint8, header.shape[:3], *orientation
+            )
+        else:
+            self.output = self.volume = numpy.memmap(
+                os.path.join(path, "output_mask.raw"), dtype=numpy.uint8, mode="w+", shape=header.shape[:3]
+            )
+
+    # Decodes the mask of the Z-th slice (labels 0 ... 255 of one channel)
+    def add(self, z, data):
+        import numpy
+
+        labels, _ = loadSlice(self.header.masks[z], crop=self.header.crop)
+        if labels.shape != self.volume.shape[1:]:
+            raise ConversionError(f"Mask differs in size or channels from its slice: {self.header.masks[z]}", ERR_MASK)
+
+        if labels.dtype != numpy.bool_ and labels.dtype != numpy.uint8 and (labels.min() < 0 or labels.max() > 255):
+            raise ConversionError(f"Mask labels do not fit into MET_UCHAR (0 ... 255): {self.header.masks[z]}", ERR_MASK)
+
+        self.volume[z] = labels
+
+    # Flushes the labels (compressed to output_mask.zraw if asked for) and writes the MHD header
+    def close(self, compress = False, pool = None, jobs = 1):
+        import numpy
+
+        if self.output is not None:
+            self.output.flush()
+            self.output = self.volume = None
+        if self.profile is not None:
+            self.profile.written(int(numpy.prod(self.header.shape[:3])))
+
+        header = MHDHeader(
+            [], "L", 1, self.header.dim_size, "MET_UCHAR",
+            self.header.element_size, self.header.element_spacing, self.header.anatomical_orientation
+        )
+        header.offset = self.header.offset
+        header.element_data_file = "output_mask.raw"
+
+        if compress:
+            header.element_data_file = "output_mask.zraw"
+            compressRAW(header, self.path, [header.element_data_file], True, pool, self.profile, jobs)
+
+        writeMHD(os.path.join(self.path, "output_mask.mhd"), header)
+
+
+# ================================================================================
+#   Returns a function clipping values to [low, high] and rescaling them to the
+#   full range of the given data type ([0, 1] for floating point types)
+# ================================================================================
+def getRescale(low, high, dtype):
+    import numpy
+
+    if numpy.issubdtype(dtype, numpy.integer):
+        minimum, maximum = numpy.iinfo(dtype).min, numpy.iinfo(dtype).max
+    else:
+        minimum, maximum = 0, 1
+
+    def rescale(data):
+        data = numpy.clip(numpy.asarray(data, dtype=numpy.float64), low, high)
+        data = (data - low) * ((maximum - minimum) / (high - low) if high > low else 0) + minimum
+        return numpy.rint(data) if numpy.issubdtype(dtype, numpy.integer) else data
+
+    return rescale
+
+
+# ================================================================================
+#   Returns the smallest integer ElementType holding all values of the range
+#
+#   Floating point types are kept as they are (narrowing would not be lossless).
+# ================================================================================
+def getMinimalElementType(element_type, minimum, maximum):
+    import numpy
+
+    if not numpy.issubdtype(getDataType(element_type), numpy.integer):
+        return element_type
+
+    for candidate in ["MET_UCHAR", "MET_CHAR", "MET_USHORT", "MET_SHORT", "MET_UINT", "MET_INT"]:
+        limits = numpy.iinfo(getDataType(candidate))
+        if limits.min <= minimum and maximum <= limits.max:
+            return candidate
+
+    return element_type
+
+
+# ================================================================================
+#       Converts a RAW file of count slices to another data type in place
+#
+#   Narrowing goes front to back: the new slice z never reaches the old slices
+#   after z. Widening goes back to front (the file is extended first) for the
+#   same reason. Only one slice is held in memory. Values are mapped by the
+#   given function (if any) before being cast.
+# ================================================================================
+def convertRAW(path, count, dtype, new_dtype, function = None, profile = None):
+    import numpy
+
+    dtype, new_dtype = numpy.dtype(dtype), numpy.dtype(new_dtype)
+    elements = os.path.getsize(path) // dtype.itemsize
+    size = elements * new_dtype.itemsize
+
+    if size > elements * dtype.itemsize:
+        os.truncate(path, size)
+
+    raw = numpy.memmap(path, dtype=numpy.uint8, mode="r+")
+    old = raw[:elements * dtype.itemsize].view(dtype).reshape(count, -1)
+    new = raw[:size].view(new_dtype).reshape(count, -1)
+
+    for z in (range(0, count) if new_dtype.itemsize <= dtype.itemsize else range(count - 1, -1, -1)):
+        data = numpy.array(old[z])
+        new[z] = (data if function is None else function(data)).astype(new_dtype)
+
+    raw.flush()
+    del raw, old, new
+
+    os.truncate(path, size)
+    if profile is not None:
+        profile.written(size)
+
+
+# ================================================================================
+#       Copies size bytes from offset of the source file to the given path
+#
+#   The copy is done by the system (copy_file_range) where possible, otherwise
+#   in large chunks. The data is never held in memory as a whole.
+# ================================================================================
+def copyRange(source, offset, size, path):
+    with open(source, "rb") as src, open(path, "wb") as dst:
+        if hasattr(os, "copy_file_range"):
+            try:
+                while size > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), size, offset)
+                    if copied == 0:
+                        break
+
+                    offset += copied
+                    size -= copied
+            except OSError:
+                # Not supported (e.g. between file systems), copy the rest below
+                pass
+
+        src.seek(offset)
+        while size > 0:
+            chunk = src.read(min(size, 1 << 24))
+            if len(chunk) == 0:
+                break
+
+            dst.write(chunk)
+            size -= len(chunk)
+
+
+# ================================================================================
+#       Writes the whole buffer at the given byte offset of the open file
+#
+#   os.pwrite may write less than given (large buffers, signals), the rest is
+#   written by further calls. The file position is not used, so any number of
+#   threads (or processes) can write into the same file at once.
+# ================================================================================
+def writeAt(fd, data, offset):
+    data = memoryview(data).cast("B")
+
+    while len(data) != 0:
+        written = os.pwrite(fd, data, offset)
+        data, offset = data[written:], offset + written
+
+
+# ================================================================================
+#       Reads size bytes at the given byte offset of the open file (see writeAt)
+# ================================================================================
+def readAt(fd, size, offset):
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = os.pread(fd, size - len(data), offset + len(data))
+        if len(chunk) == 0:
+            raise OSError(f"File ends before {size} bytes at offset {offset}")
+        data += chunk
+
+    return data
+
+
+# ================================================================================
+#       Returns how to reorient a volume (Z, Y, X) between orientation codes
+#
+#   Returns the numpy axes to transpose by and the axes (after transposing) to
+#   flip, so that target = flip(volume.transpose(axes), flips). Axis k of the
+#   code (X, Y, Z) is numpy axis 2 - k, channels (if any) stay last.
+# ================================================================================
+def getReorientation(source, target):
+    axes, flips = [], []
+
+    for k in range(2, -1, -1):
+        pair = next(pair for pair in ORIENTATION_PAIRS if target[k] in pair)
+        j = next(j for j in range(0, 3) if source[j] in pair)
+
+        axes.append(2 - j)
+        if source[j] != target[k]:
+            flips.append(2 - k)
+
+    return axes, flips
+
+
+# ================================================================================
+#       Reorients the header (DimSize, ElementSize/ Spacing and Offset)
+#
+#   The Offset is kept in the voxel coordinates of the target orientation, a
+#   flipped axis starts at the (negated) position of its former last voxel.
+# ================================================================================
+def reorientHeader(header, source, target):
+    axes, flips = getReorientation(source, target)
+    order = [2 - axes[2 - k] for k in range(0, 3)]
+
+    offset = header.offset or (0, 0, 0)
+    offset = [offset[j] for j in order]
+
+    header.dim_size = [header.dim_size[j] for j in order]
+    header.element_size = [header.element_size[j] for j in order]
+    header.element_spacing = [header.element_spacing[j] for j in order]
+
+    for k in (2 - axis for axis in flips):
+        offset[k] = -(offset[k] + (header.dim_size[k] - 1) * header.element_spacing[k])
+
+    if header.offset is not None or len(flips) != 0:
+        header.offset = offset
+    header.anatomical_orientation = target
+
+
+# ================================================================================
+#       Creates a RAW file of the volume reoriented between orientation codes
+#
+#   The volume of the given shape (Z, Y, X (+ channels)) is stored reoriented to
+#   path. Returns the memory-mapped output and its view in the order of the
+#   volume (flips undone, axes transposed back), so slices written to view[z]
+#   land reoriented in the output.
+# ================================================================================
+def openReoriented(path, dtype, shape, source, target):
+    import numpy
+
+    axes, flips = getReorientation(source, target)
+    channels = list(range(3, len(shape)))
+
+    output = numpy.memmap(
+        path, dtype=dtype, mode="w+", shape=tuple(shape[axis] for axis in axes) + tuple(shape[3:])
+    )
+
+    view = numpy.flip(output, flips) if len(flips) != 0 else output
+    view = view.transpose(list(numpy.argsort(axes)) + channels)
+
+    return output, view
+
+
+# ================================================================================
+#       Writes the volume reoriented between the orientation codes to path
+#
+#   The output is memory-mapped and filled slab-wise in the order of the
+#   (memory-mapped) volume, only one slab of about 64 MiB is read at a time.
+#   Slabs are copied on the worker pool (if any), they never overlap.
+# ================================================================================
+def reorientRAW(volume, path, source, target, pool = None, profile = None, slab_size = 1 << 26):
+    output, view = openReoriented(path, volume.dtype, volume.shape, source, target)
+
+    depth = max(1, slab_size // max(1, volume[0].nbytes))
+
+    def copySlab(z):
+        view[z:z + depth] = volume[z:z + depth]
+
+    mapSlices(pool, copySlab, range(0, volume.shape[0], depth))
+
+    output.flush()
+    del output, view
+
+    if profile is not None:
+        profile.written(volume.nbytes)
+
+
+# ================================================================================
+#       Returns size and modification time of a slice (used by the cache)
+# ================================================================================
+def statSlice(file):
+    stat = os.stat(file[0] if isFrame(file) else file)
+
+    return {
+        "file" : os.path.abspath(file[0] if isFrame(file) else file),
+        "size" : stat.st_size,
+        "mtime" : stat.st_mtime_ns
+    } | ({"frame" : file[1]} if isFrame(file) else {})
+
+
+# ================================================================================
+#           Reads the cache of a previous conversion next to output.mhd
+#
+#   The cache is only usable if it was created for the very same MHD header
+#   (DimSize, ElementType, spacing, data files, ...). Returns its slices or None.
+# ================================================================================
+def readCache(path, information):
+    try:
+        with open(path, "r") as in_file:
+            cache = json.load(in_file)
+
+        assert cache["header"] == information
+        return cache["slices"]
+    except Exception:
+        return None
+
+
+# ================================================================================
+#           Writes the cache (MHD header and every slices state) to file
+# ================================================================================
+def writeCache(path, information, slices):
+    with open(path, "w") as out_file:
+        json.dump({"header" : information, "slices" : slices}, out_file, indent=4)
+
+
+# ================================================================================
+#       Returns the indexes of all slices changed since they were cached
+#
+#   Slices with same file, size and modification time are unchanged. Otherwise
+#   the content hash decides (computed in parallel if a pool is given). Hashes
+#   of unchanged slices are taken over from the cache.
+# ================================================================================
+def findChangedSlices(slices, cached, pool = None):
+    suspects = []
+    changed = []
+    for i in range(0, len(slices)):
+        if all(slices[i].get(key) == cached[i].get(key) for key in ["file", "size", "mtime", "frame"]):
+            slices[i]["hash"] = cached[i]["hash"]
+        elif "frame" in slices[i]:
+            # Frames of a changed multi-frame file can not be hashed on their own
+            changed.append(i)
+        else:
+            suspects.append(i)
+
+    def hashFile(i):
+        with open(slices[i]["file"], "rb") as in_file:
+            return hashSlice(in_file.read())
+
+    for i, hashed in zip(suspects, mapSlices(pool, hashFile, suspects)):
+        if slices[i]["file"] == cached[i]["file"] and hashed == cached[i]["hash"]:
+            # Only touched, content is still the same
+            slices[i]["hash"] = hashed
+        else:
+            changed.append(i)
+
+    return sorted(changed)
+
+
+
+# ================================================================================
+#           Returns the numpy data type for the ElementType (MHD) given
+# ================================================================================
+DATA_TYPES = {
+    "MET_CHAR" : "int8",
+    "MET_UCHAR" : "uint8",
+    "MET_SHORT" : "int16",
+    "MET_USHORT" : "uint16",
+    "MET_INT" : "int32",
+    "MET_UINT" : "uint32",
+    "MET_LONG" : "int32",
+    "MET_ULONG" : "uint32",
+    "MET_LONG_LONG" : "int64",
+    "MET_ULONG_LONG" : "uint64",
+    "MET_FLOAT" : "float32",
+    "MET_DOUBLE" : "float64"
+}
+
+def getDataType(element_type):
+    import numpy
+
+    if element_type not in DATA_TYPES:
+        return None
+
+    return numpy.dtype(DATA_TYPES[element_type]).type
+
+
+# ================================================================================
+#       Returns the ElementType (MHD) for the numpy data type given or None
+# ================================================================================
+def getElementTypeOfDataType(dtype):
+    import numpy
+
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == "b":
+        # Booleans are stored as one byte
+        return "MET_UCHAR"
+
+    for element_type in ["MET_CHAR", "MET_UCHAR", "MET_SHORT", "MET_USHORT", "MET_INT", "MET_UINT",
+                         "MET_LONG_LONG", "MET_ULONG_LONG", "MET_FLOAT", "MET_DOUBLE"]:
+        if numpy.dtype(DATA_TYPES[element_type]) == dtype.newbyteorder("="):
+            return element_type
+
+    return None
+
+
+# ================================================================================
+#       Returns the ElementType (MHD) for the image mode (PIL) given or None
+#
+#   Modes: https://pillow.readthedocs.io/en/5.1.x/handbook/concepts.html#modes
+# ================================================================================
+def getElementType(mode):
+    if mode in ['1', 'L', 'La', 'LA', 'P', 'PA', 'RGB', 'RGBX', 'RGBa', 'RGBA', 'CMYK', 'YCbCr', 'LAB', 'HSV']:
+        # Everything 1 Byte data types -> MET_UCHAR or MET_CHAR (assume first)
+        return "MET_UCHAR"
+    elif mode in ['I;16', 'I;16L', 'I;16B', 'I;16N', 'BGR;15', 'BGR;16']:
+        # 2 Byte unsigned integer pixels -> MET_USHORT
+        return "MET_USHORT"
+    elif mode in ['BGR;24', 'BGR;32']:
+        # 4 Byte unsigned integer pixels -> MET_UINT
+        return "MET_UINT"
+    elif mode == "I":
+        # 4 Byte signed integer pixels -> MET_INT
+        return "MET_INT"
+    elif mode == "F":
+        # 4 Byte floating point pixels -> MET_FLOAT
+        return "MET_FLOAT"
+
+    return None
+
+
+# ================================================================================
+#           Error raised by a conversion, carrying the error code to return
+# ================================================================================
+class ConversionError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+# ================================================================================
+#               Header of a MetaIO (MHD) image and its source slices
+#
+#   Sizes and spacings are given as (X, Y, Z), the volume itself is stored as
+#   (Z, Y, X) (+ channels if more than one) as given by shape.
+#   Offset is only written for sub-volumes (range, crop) to keep them in place.
+#   TODO: Fields: TransformMatrix, CenterOfRotation
+# ================================================================================
+class MHDHeader:
+    def __init__(self, files, mode, channels, dim_size, element_type,
+                 element_size, element_spacing, anatomical_orientation):
+        self.files = files                                      # sorted source slices
+        self.mode = mode                                        # image mode (PIL)
+        self.channels = channels
+        self.dim_size = dim_size
+        self.element_type = element_type
+        self.element_size = element_size
+        self.element_spacing = element_spacing
+        self.byte_order_msb = sys.byteorder != "little"
+        self.anatomical_orientation = anatomical_orientation
+        self.element_data_file = "output.raw"                   # file name or list (LIST 2D)
+        self.compressed_data = False
+        self.compressed_data_size = None
+        self.header_size = 0                                    # bytes skipped in data file
+        self.volume = None                                      # memory-mapped volume input
+        self.offset = None                                      # origin (X Y Z), 0 if not given
+        self.crop = None                                        # (x, y, width, height) of every slice
+        self.masks = None                                       # mask paired with every slice
+        self.z_range = None                                     # (first, last, slices of the input) if selected
+        self.color = None                                       # conversion of color slices to scalars (see toScalar)
+
+    @property
+    def shape(self):
+        return tuple(reversed(self.dim_size)) + ((self.channels,) if self.channels > 1 else ())
+
+    @property
+    def dtype(self):
+        return getDataType(self.element_type)
+
+    # Returns the lines of the MHD file
+    def lines(self):
+        information = [
+            "ObejctType = Image",
+            "NDims = 3",
+            "DimSize = " + " ".join(str(value) for value in self.dim_size),
+            "ElementType = " + self.element_type,
+            "HeaderSize = " + str(self.header_size),
+            "BinaryData = True ",
+            "BinaryDataByteOrderMSB = " + str(self.byte_order_msb),
+            "ElementSize = " + " ".join(str(value) for value in self.element_size),
+            "ElementSpacing = " + " ".join(str(value) for value in self.element_spacing),
+            "ElementByteOrderMSB = " + str(self.byte_order_msb),
+            "AnatomicalOrientation = " + self.anatomical_orientation
+        ]
+
+        if self.offset is not None:
+            information.append("Offset = " + " ".join(str(value) for value in self.offset))
+
+        if self.compressed_data:
+            # Not given for LIST 2D, as the size differs for every file
+            information[6:6] = ["CompressedData = True"] + (
+                [] if self.compressed_data_size is None else
+                ["CompressedDataSize = " + str(self.compressed_data_size)]
+            )
+
+        if self.channels > 1:
+            # Vector image (e.g. RGB), channels of every voxel stored one after another
+            information.insert(3, "ElementNumberOfChannels = " + str(self.channels))
+
+        if isinstance(self.element_data_file, list):
+            information.append("ElementDataFile = LIST 2D")
+            information.extend(self.element_data_file)
+        else:
+            information.append("ElementDataFile = " + self.element_data_file)
+
+        return information
+
+
+# ================================================================================
+#                       Writes the MHD header to the given path
+# ================================================================================
+def writeMHD(path, header):
+    with open(path, "w") as mhd:
+        for line in header.lines():
+            mhd.write(line + "\n")
+
+
+# ================================================================================
+#       Reads and validates the meta information and anatomical orientation
+#
+#   Returns the meta information (see validateMeta) with corrected orientation,
+#   the ElementSize and ElementSpacing (X, Y, Z) for the given series.
+# ================================================================================
+def readMeta(meta_path, series, profile = None):
+    #   Validate meta data
+    #   ==================
+    with profileStage(profile, "validateMeta"):
+        meta_info = list(validateMeta(meta_path))
+    if None in meta_info:
+        raise ConversionError("Meta.json was not fully functional as relevant portions for MHD where missing!", ERR_META)
+
+
+    #   Validate anatomical orientation
+    #   ===============================
+    meta_info[6] = validateAnatomicalOrientation(meta_info[6])
+    if not meta_info[6]:
+        # anatomical orientation is wrong or can not be corrected!
+        raise ConversionError("Anatomical orientation in meta data wrong!", ERR_META_AO)
+
+    if series.upper() == "DSA":
+        # ElementSize + ElementSpacing (X Y Z)
+        return meta_info, (1, 1, 1), (1, 1, 1)
+
+    return meta_info, (meta_info[2], meta_info[2], meta_info[2]), (meta_info[3], meta_info[4], meta_info[5])
+
+
+# ================================================================================
+#       Returns the anatomical orientation of Meta.json in its given order
+#
+#   readMeta rebuilds the orientation as [R|L][A|P][S|I], the order of the axes
+#   is needed to reorient the voxels (see validateOrientationCode).
+# ================================================================================
+def getSourceOrientation(meta_path):
+    source = validateOrientationCode(validateMeta(meta_path)[6])
+    if source is None:
+        raise ConversionError("Anatomical orientation in meta data wrong!", ERR_META_AO)
+
+    return source
+
+
+# ================================================================================
+#       Reads the header of a volume input (NPY/ RAW) by memory-mapping it
+#
+#   A .npy file is read as (Z, Y, X), a RAW file needs its ElementType to be
+#   given, its shape is taken from Meta.json (columns, rows) and the file size.
+#   The volume is kept memory-mapped as header.volume, nothing is read yet.
+# ================================================================================
+def readVolumeHeader(img_path, meta_path, img_type = "NPY", series = "MRA", element = None, profile = None,
+                     z_range = None, crop = None):
+    import numpy
+
+    #   Validate series type
+    #   ====================
+    if not validateSeries(series):
+        # Series is neather DSA nor MRA
+        raise ConversionError("Wrong Series given!", ERR_SERIES)
+
+
+    #   Validate volume input
+    #   =====================
+    with profileStage(profile, "validateImage"):
+        if not os.path.isfile(img_path):
+            raise ConversionError("No suitable path given, volume input has to be a single file!", ERR_INPUT)
+
+        if img_type.upper() == "NPY":
+            try:
+                volume = numpy.load(img_path, mmap_mode="r")
+            except Exception:
+                raise ConversionError("Given file is not a readable numpy array (.npy)!", ERR_INPUT)
+
+            offset = volume.offset
+        else:
+            volume, offset = None, 0
+
+
+    #   Validate meta data and anatomical orientation
+    #   =============================================
+    meta_info, element_size, element_spacing = readMeta(meta_path, series, profile)
+
+    if volume is None:
+        # RAW volume: (Z, rows, columns) of the given element type
+        dtype = getDataType(str(element).upper())
+        if dtype is None:
+            raise ConversionError("RAW volume input requires a correct element type (-element)!", ERR_ELEMENT)
+
+        slice_size = meta_info[0] * meta_info[1] * numpy.dtype(dtype).itemsize
+        if slice_size == 0 or os.path.getsize(img_path) % slice_size != 0:
+            raise ConversionError("Size of RAW volume does not match columns and rows given in meta data!", ERR_INPUT)
+
+        volume = numpy.memmap(
+            img_path, dtype=dtype, mode="r", shape=(os.path.getsize(img_path) // slice_size, meta_info[1], meta_info[0])
+        )
+
+    if volume.ndim == 2:
+        # One single slice
+        volume = volume[numpy.newaxis]
+
+    if volume.ndim != 3 or volume.size == 0:
+        raise ConversionError(f"Volume input has to be of shape (Z, Y, X) but is {volume.shape}!", ERR_INPUT)
+
+
+    #   Select sub-volume (views of the memory map, nothing is read)
+    #   ============================================================
+    first, x, y = 0, 0, 0
+    if z_range is not None:
+        first, last = validateRegion(z_range, None, volume.shape[0], volume.shape[2], volume.shape[1])[0]
+        volume = volume[first:last]
+
+        # Slices skipped within the file
+        offset += first * volume[0].nbytes
+
+    if crop is not None:
+        x, y, width, height = validateRegion(None, crop, volume.shape[0], volume.shape[2], volume.shape[1])[1]
+        volume = volume[:, y:y + height, x:x + width]
+
+
+    #   Validate volume data type
+    #   =========================
+    element_type = getElementTypeOfDataType(volume.dtype)
+    if element_type is None:
+        raise ConversionError(f"The given volume data type is not supported: {volume.dtype}", ERR_IMG_TYPE_DEPTH)
+
+    header = MHDHeader(
+        [], None, 1, tuple(reversed(volume.shape)), element_type,
+        element_size, element_spacing, meta_info[6]
+    )
+
+    header.volume = volume
+    header.header_size = offset
+    if volume.dtype.byteorder in ["<", ">"]:
+        header.byte_order_msb = volume.dtype.byteorder == ">"
+
+    if z_range is not None or crop is not None:
+        header.offset = (x * element_spacing[0], y * element_spacing[1], first * element_spacing[2])
+
+    return header
+
+
+# ================================================================================
+#       Validates slice range and crop box against the size of the input
+#
+#   Returns ((first, last), (x, y, width, height)) with the range closed. Raises
+#   a ConversionError if they are incorrect or exceed the input.
+# ================================================================================
+def validateRegion(z_range, crop, slices, width, height):
+    if z_range is not None:
+        z_range = validateRange(z_range) if isinstance(z_range, str) else z_range
+        if z_range is None or z_range[0] >= slices or (z_range[1] or slices) > slices:
+            raise ConversionError(f"Wrong slice range given (input has {slices} slices)!", ERR_RANGE)
+
+        z_range = (z_range[0], z_range[1] or slices)
+
+    if crop is not None:
+        crop = validateCrop(crop) if isinstance(crop, str) else crop
+        if crop is None or crop[0] + crop[2] > width or crop[1] + crop[3] > height:
+            raise ConversionError(f"Wrong crop box given (slices are {width}x{height})!", ERR_CROP)
+
+    return z_range, crop
+
+
+# ================================================================================
+#       Reads the header of an image input and its meta information:
+#   1) Validate input image type
+#   2) Validate series type
+#   3) Validate input file/folder (and sort slices)
+#   4) Validate slices match each other (headers only, within slice range)
+#   5) Validate meta information
+#   6) Validate anatomical orientation
+#   7) Validate image data type (ElementType)
+#   8) Validate color conversion
+#
+#   Returns a MHDHeader (nothing is decoded yet). Raises a ConversionError if
+#   something went wrong. Volume input (NPY/ RAW) is read by readVolumeHeader.
+#   A slice range (first, last) or "First:Last" and a crop box (x, y, width,
+#   height) or "X,Y,Width,Height" select a sub-volume, moved by Offset. The
+#   slice list is kept in the directory index (if a path is given). With masks,
+#   the mask file of the same number as every slice is kept in header.masks.
+#   A shard (i, n) selects the i-th of n equal parts of the slices as range.
+#   Color slices are written as vectors (ElementNumberOfChannels) unless color
+#   names a conversion to scalars ("LUMINANCE" or a band, see toScalar).
+# ================================================================================
+def readHeader(img_path, meta_path, img_type = "PNG", series = "MRA", pool = None, profile = None, element = None,
+               z_range = None, crop = None, index = None, masks = False, shard = None, color = None):
+    if img_type.upper() in VOLUME_TYPES:
+        return readVolumeHeader(img_path, meta_path, img_type, series, element, profile, z_range, crop)
+
+    #   Validate input image type
+    #   =========================
+    if not validateImageType(img_type):
+        # Image type not supported
+        raise ConversionError("Image type is not supported (yet)!", ERR_IMG_TYPE)
+
+
+    #   Validate series type
+    #   ====================
+    if not validateSeries(series):
+        # Series is neather DSA nor MRA
+        raise ConversionError("Wrong Series given!", ERR_SERIES)
+
+
+    #   Validate input file/ folder is correct
+    #   ======================================
+    with profileStage(profile, "validateImage"):
+        # sorted by file names where filenames are numbered ([…].0.xyz ... […].1000.xyz ...)
+        scan = scanImages(img_path, img_type, index)
+        files = scan["files"] + scan["unnumbered"]
+        if len(files) == 0:
+            raise ConversionError("No suitable path given or directory does not contain images from given type!", ERR_INPUT)
+
+        if len(files) > 1:
+            if len(scan["unnumbered"]) != 0:
+                raise ConversionError("MHD files require slices (images) to be sorted but given file names can not be sorted!", ERR_IMG_NAMES)
+
+            if len(scan["duplicates"]) != 0:
+                raise ConversionError(f"Slice numbers given more than once: {scan['duplicates'][:10]}", ERR_IMG_NAMES)
+
+            if len(scan["gaps"]) != 0:
+                print(f"Slice numbers missing (gaps in the volume): {scan['gaps'][:10]}{' ...' if len(scan['gaps']) > 10 else ''}")
+        elif os.path.isfile(img_path):
+            # Every frame of a multi-frame file (TIFF/ GIF) is a slice
+            frames = countFrames(files[0])
+            if frames > 1:
+                files = [(files[0], frame) for frame in range(0, frames)]
+
+        if shard is not None:
+            # Shard i of n, the parts differ by one slice at most
+            if shard[1] > len(files):
+                raise ConversionError(f"More shards given than slices ({len(files)})!", ERR_SHARD)
+
+            z_range = (len(files) * shard[0] // shard[1], len(files) * (shard[0] + 1) // shard[1])
+
+        # Slices outside of the range are never opened
+        first, slices = 0, len(files)
+        if z_range is not None:
+            first, last = validateRegion(z_range, None, len(files), 0, 0)[0]
+            files = files[first:last]
+
+        if masks:
+            # Every slice is paired with the mask of the same number
+            if not os.path.isdir(img_path) or len(scan["unnumbered"]) != 0:
+                raise ConversionError("Masks can only be paired with numbered slices of a folder!", ERR_MASK)
+
+            numbers = {getSliceNumber(mask) : mask for mask in scan["masks"]}
+            missing = [file for file in files if getSliceNumber(file) not in numbers]
+            if len(missing) != 0:
+                raise ConversionError(f"No mask of the same number found for {len(missing)} slice(s): {missing[:10]}", ERR_MASK)
+
+            masks = [numbers[getSliceNumber(file)] for file in files]
+
+    with profileStage(profile, "consistency"):
+        image, differ = validateConsistency(files, pool)
+    if image is None or len(differ) != 0:
+        for file in ([files[0]] if image is None else differ):
+            print(f"Image differs in type or size or can not be read: {file[0] + ' (frame ' + str(file[1]) + ')' if isFrame(file) else file}")
+        raise ConversionError("Images differ in type or size, information does not match!", ERR_INPUT_DIFFER)
+
+    (width, height), mode, _, channels = image
+    if crop is not None:
+        crop = validateRegion(None, crop, len(files), width, height)[1]
+        width, height = crop[2:]
+
+
+    #   Validate meta data and anatomical orientation
+    #   =============================================
+    meta_info, element_size, element_spacing = readMeta(meta_path, series, profile)
+
+
+    #   Validate image data type
+    #   ========================
+    element_type = getElementType(mode)
+    if element_type is None:
+        raise ConversionError(f"The given image(s) bitdepth was not 8-Bit, 16-Bit, 32-Bit, 64-Bit or it was not implemented (correctly): {mode}", ERR_IMG_TYPE_DEPTH)
+
+
+    #   Validate color conversion (one scalar per voxel)
+    #   ================================================
+    bands = getColorBands(mode)
+    if color == "LUMINANCE" and bands[0] not in ["L", "P"] and bands[:3] != ["R", "G", "B"]:
+        raise ConversionError(f"Luminance can not be computed for image mode {mode}!", ERR_COLOR)
+
+    if color not in [None, "VECTOR", "LUMINANCE"] and color not in bands:
+        raise ConversionError(f"Band {color} not found in image mode {mode} (bands {', '.join(bands)})!", ERR_COLOR)
+
+    if color is not None and color != "VECTOR" and (len(bands) > 1 or bands[0] == "P" and color == "LUMINANCE"):
+        # Palette indices are kept unless converted to luminance
+        channels = 1
+    else:
+        color = None
+
+    header = MHDHeader(
+        files, mode, channels, (width, height, len(files)), element_type,
+        element_size, element_spacing, meta_info[6]
+    )
+    header.color = color
+
+    if z_range is not None:
+        header.z_range = (first, last, slices)
+
+    if z_range is not None or crop is not None:
+        # Sub-volume stays in place (origin of the whole volume is 0)
+        header.crop = crop
+        header.offset = (
+            (crop[0] if crop else 0) * element_spacing[0],
+            (crop[1] if crop else 0) * element_spacing[1],
+            first * element_spacing[2]
+        )
+
+    if masks:
+        header.masks = masks
+
+    # Slice list only kept once validated
+    writeIndex(scan)
+
+    return header
+
+
+# ================================================================================
+#       Reads the volume of the given header (decoding all its slices)
+#
+#   Without out, a new contiguous numpy array of header.shape is returned. If out
+#   is a writable buffer (bytearray, numpy array, mmap, ...) the slices are decoded
+#   straight into it and an array using its memory is returned. If out is a file
+#   object, the slices are written to it one after another (returning None).
+#   For volume input (NPY/ RAW) its memory map is returned without reading.
+#   Jobs is the number of workers of the pool (if any).
+# ================================================================================
+def readVolume(header, out = None, pool = None, jobs = 1):
+    import numpy
+
+    if header.volume is not None:
+        # Volume input is memory-mapped already
+        if out is None:
+            return header.volume
+
+        if hasattr(out, "write"):
+            for z in range(0, header.volume.shape[0]):
+                out.write(numpy.ascontiguousarray(header.volume[z]))
+            return None
+
+        volume = numpy.frombuffer(out, dtype=header.volume.dtype, count=header.volume.size).reshape(header.volume.shape)
+        volume[...] = header.volume
+        return volume
+
+    if isFrame(header.files[0]):
+        # Frames are read one after another from one open file
+        pool = None
+
+    if out is not None and hasattr(out, "write"):
+        for data in streamSlices(pool, lambda file: decodeSlice(file, header.dtype, header.crop, header.color), header.files, jobs):
+            out.write(data)
+        closeFrames()
+        return None
+
+    if out is None:
+        volume = numpy.empty(header.shape, dtype=header.dtype)
+    else:
+        volume = numpy.frombuffer(
+            out, dtype=header.dtype, count=int(numpy.prod(header.shape))
+        ).reshape(header.shape)
+
+    readSlices(header.files, volume, pool, crop=header.crop, color=header.color)
+    closeFrames()
+    return volume
+
+
+# ================================================================================
+#       Converts an image input to a MHD header and its volume in memory
+#
+#   Usage as a library (nothing is written to disk):
+#       header, volume = img2mhd.convertImage("slices/", "Meta.json")
+#
+#   See readHeader and readVolume for the parameters.
+# ================================================================================
+def convertImage(img_path, meta_path, img_type = "PNG", series = "MRA", out = None, pool = None, jobs = 1):
+    header = readHeader(img_path, meta_path, img_type, series, pool)
+
+    return header, readVolume(header, out, pool, jobs)
+
+
+# ================================================================================
+#       Converts the image input described by the validated parameters:
+#   1) Validate RAW output type and options
+#   2) Read header (see readHeader)
+#   3) Check for changed slices (if incremental)
+#   4) RAW output (reoriented, pyramid levels or mask, if asked for)
+#   5) Narrow ElementType (if chosen automatically) or rescale to window
+#   6) Reorient header and compress (if asked for)
+#   7) Statistics and MHD output
+#
+#   Slices are decoded on the given worker pool (if any), which may be shared by
+#   multiple conversions. Raises a ConversionError if something went wrong.
+#
+#   TODO: inform user, if only one image given but "Multiple" raw output selected!
+# ================================================================================
+def convert(res, pool = None, profile = None):
+    import numpy
+
+    # Workers of the pool (validated before creating it)
+    jobs = validateJobs(res.get("jobs", "1")) or 1
+
+    #   Validate RAW output
+    #   ===================
+    if not validateRAW(res["out_raw"]):
+        # RAW output matches neather Simple nor Multiple
+        raise ConversionError("Wrong RAW output given!", ERR_RAW)
+
+    compress = validateSwitch(res.get("compress", "False"))
+    if compress is None:
+        raise ConversionError("Wrong compression option given!", ERR_COMPRESS)
+
+    cache = validateSwitch(res.get("cache", "False"))
+    if cache is None:
+        raise ConversionError("Wrong cache option given!", ERR_CACHE)
+
+    dir_index = validateSwitch(res.get("index", "False"))
+    if dir_index is None:
+        raise ConversionError("Wrong directory index option given!", ERR_INDEX)
+
+    stats = validateSwitch(res.get("stats", "False"))
+    if stats is None:
+        raise ConversionError("Wrong statistics option given!", ERR_STATS)
+
+    window = None if res.get("window") is None else validateWindow(res["window"])
+    if res.get("window") is not None and window is None:
+        raise ConversionError("Wrong intensity window given (percentiles Low,High)!", ERR_STATS)
+
+    if window is not None and (cache or res["img_type"].upper() in VOLUME_TYPES):
+        raise ConversionError("Intensity window is not possible for volume input or with cache!", ERR_STATS)
+
+    auto = str(res.get("element")).upper() == "AUTO"
+    if res.get("element") is not None and res["img_type"].upper() not in VOLUME_TYPES and not auto:
+        if window is None:
+            raise ConversionError("Element type of image input can only be chosen automatically (-element Auto) or with an intensity window!", ERR_ELEMENT)
+
+        if getDataType(res["element"].upper()) is None:
+            raise ConversionError("Wrong element type given!", ERR_ELEMENT)
+
+    if res.get("element") is not None and res["img_type"].upper() == "NPY":
+        # Element type of NPY input is given by the array itself
+        raise ConversionError("Element type can only be given for RAW volume input, not for NPY!", ERR_PARAMS_INCORRECT)
+
+    if auto and (cache or window is not None or res["img_type"].upper() in VOLUME_TYPES):
+        raise ConversionError("Automatic element type is not possible for volume input, with cache or intensity window!", ERR_ELEMENT)
+
+    factors = validatePyramid(res.get("pyramid", "False"))
+    if factors is None:
+        raise ConversionError("Wrong pyramid levels given!", ERR_PYRAMID)
+
+    orient = None if res.get("orient") is None else validateOrientationCode(res["orient"])
+    if res.get("orient") is not None and orient is None:
+        raise ConversionError("Wrong target orientation given (e.g. RAI)!", ERR_ORIENT)
+
+    if orient is not None and (cache or res["out_raw"].upper() != "SIMPLE"):
+        raise ConversionError("Reorientation is only possible for Simple RAW output without cache!", ERR_ORIENT)
+
+    if orient is not None and len(factors) != 0 and res["img_type"].upper() not in VOLUME_TYPES:
+        raise ConversionError("Reorientation of image input is not possible with pyramid levels!", ERR_ORIENT)
+
+    mask = validateSwitch(res.get("mask", "False"))
+    if mask is None:
+        raise ConversionError("Wrong mask option given!", ERR_MASK)
+
+    if mask and (cache or res["img_type"].upper() in VOLUME_TYPES):
+        raise ConversionError("Masks are only converted from image input without cache!", ERR_MASK)
+
+    watch = validateWatch(res.get("watch", "False"))
+    if watch is None:
+        raise ConversionError("Wrong watch option given!", ERR_WATCH)
+
+    color = None if res.get("color") is None else validateColor(res["color"])
+    if res.get("color") is not None and (color is None or res["img_type"].upper() in VOLUME_TYPES):
+        raise ConversionError("Wrong color conversion given (Luminance, Vector or a band of image input)!", ERR_COLOR)
+
+    max_memory = None if res.get("max_memory") is None else validateMemory(res["max_memory"])
+    if res.get("max_memory") is not None and max_memory is None:
+        raise ConversionError("Wrong memory budget given (MiB)!", ERR_MEMORY)
+
+    shard = None if res.get("shard") is None else validateShard(res["shard"])
+    if res.get("shard") is not None and shard is None:
+        raise ConversionError("Wrong shard given (I/N, First:Last or Finalize)!", ERR_SHARD)
+
+    if shard is not None:
+        # Every shard writes its slices into the shared output.raw
+        if shard[0] == "FINALIZE":
+            return finalizeShards(res["out_path"])
+
+        if (compress or cache or len(factors) != 0 or res["out_raw"].upper() != "SIMPLE" or watch or
+                res["img_type"].upper() in VOLUME_TYPES or res.get("range") is not None or res.get("element") is not None or
+                stats or window is not None or orient is not None or mask):
+            raise ConversionError("Shards only write Simple RAW output of image input (no cache, compression, pyramid, range, element type, statistics, orientation or mask)!", ERR_SHARD)
+
+        return convertShard(res, shard, pool, profile, max_memory, color)
+
+    if watch:
+        # Slices are appended while arriving
+        if (compress or cache or len(factors) != 0 or res["out_raw"].upper() != "SIMPLE" or
+                res.get("range") is not None or res.get("element") is not None or stats or window is not None or
+                orient is not None or mask or color is not None or dir_index or max_memory is not None):
+            raise ConversionError("Watch mode only writes Simple RAW output (no cache, compression, pyramid, range, element type, statistics, orientation, mask, color conversion, directory index or memory budget)!", ERR_WATCH)
+
+        return watchSeries(res, watch, pool, profile)
+
+    if res["img_type"].upper() in VOLUME_TYPES:
+        # Volume input is only referenced or copied
+        return convertVolume(res, compress, cache, factors, pool, profile, stats, orient, jobs)
+
+    if res["out_raw"].upper() == "INPLACE":
+        raise ConversionError("RAW output Inplace is only possible for volume input (NPY/ RAW)!", ERR_RAW)
+
+
+    #   Read header of image input
+    #   ==========================
+    header = readHeader(
+        res["in_img"], res["in_meta"], res["img_type"], res["in_series"], pool, profile,
+        z_range=res.get("range"), crop=res.get("crop"),
+        index=os.path.join(res["out_path"], "output.index.json") if dir_index else None, masks=mask, color=color
+    )
+    files = header.files
+
+    # ElementDataFile (one or list)
+    simple = len(files) == 1 or res["out_raw"] == "Simple"
+    if simple:
+        header.element_data_file = "output.zraw" if compress else "output.raw"
+        raws = [header.element_data_file]
+    else:
+        # replace the file extension with raw (zraw if compressed)
+        header.element_data_file = raws = [
+            getSliceName(file) + (".zraw" if compress else ".raw") for file in files
+        ]
+
+    if isFrame(files[0]):
+        # Frames are read one after another from one open file
+        pool = None
+
+
+    #   Check for changed slices (if incremental)
+    #   =========================================
+    information = header.lines()
+    if stats:
+        information.append("Statistics = True")
+    if len(factors) != 0:
+        information.append("Pyramid = " + " ".join(str(factor) for factor in factors))
+    if header.color is not None:
+        information.append("Color = " + header.color)
+    slice_size = int(numpy.prod(header.shape[1:])) * numpy.dtype(header.dtype).itemsize
+
+    cache_path = os.path.join(res["out_path"], "output.cache.json")
+    indexes = None
+
+    if cache:
+        slices = mapSlices(pool, statSlice, files)
+        for i in range(0, len(slices)):
+            # Where the slice is stored (RAW file and byte offset)
+            slices[i]["raw"] = raws[0] if simple else raws[i]
+            slices[i]["offset"] = i * slice_size if simple else 0
+
+        cached = readCache(cache_path, information)
+        sizes = [slice_size * len(files)] if simple else [slice_size] * len(files)
+        if cached is not None and len(cached) == len(slices) and all(
+            os.path.isfile(os.path.join(res["out_path"], raws[i])) and
+            (compress or os.path.getsize(os.path.join(res["out_path"], raws[i])) == sizes[i])
+            for i in range(0, len(raws))
+        ):
+            indexes = findChangedSlices(slices, cached, pool)
+
+            # MHD headers and sidecars written next to the RAW output
+            outputs = ["output.mhd"] + (["output.stats.json"] if stats else []) + [
+                f"output_{factor}x{extension}" for factor in factors for extension in [".mhd", ".raw"]
+            ]
+            if len(indexes) == 0 and all(os.path.isfile(os.path.join(res["out_path"], output)) for output in outputs):
+                # Nothing changed since last conversion
+                print("Output is up to date, no slice changed!")
+                return
+
+            if (simple and compress) or len(factors) != 0 or stats:
+                # Compressed slices can not be replaced within the zlib stream,
+                # pyramid levels and statistics need every slice
+                indexes = None
+    elif os.path.isfile(cache_path):
+        # Cache would be outdated after converting without it
+        os.remove(cache_path)
+
+    # Create output folder if nonexistant
+    os.makedirs(res["out_path"], exist_ok=True)
+
+    pyramid = Pyramid(res["out_path"], header, factors, profile) if len(factors) != 0 else None
+    intensity = Intensity() if auto else None
+    statistics = Statistics(header.dtype) if stats or window is not None else None
+    # Voxels (and labels) written reoriented in the same pass
+    orientation = None if orient is None else (getSourceOrientation(res["in_meta"]), orient)
+
+    masks = Mask(res["out_path"], header, profile, orientation) if mask else None
+    observers = [observer for observer in [pyramid, intensity, statistics, masks] if observer is not None]
+
+    # Element type converted after writing, reoriented output compressed afterwards
+    deferred = auto or window is not None or orient is not None
+
+
+    #   Read ahead and write behind within the memory budget (if given)
+    #   ===============================================================
+    prefetch, writer = contextlib.nullcontext(), None
+    if max_memory is not None:
+        order = range(0, len(files)) if indexes is None else indexes
+        if masks is not None:
+            # Every mask is decoded right after its slice
+            order = [file for i in order for file in (files[i], header.masks[i])]
+        else:
+            order = [files[i] for i in order]
+
+        if not simple:
+            writer = WriteBehind(max_memory // 2, profile)
+        prefetch = Prefetch(order, max_memory if writer is None else max_memory // 2)
+
+
+    #   Create RAW image(s) (only changed slices if incremental)
+    #   ========================================================
+    with profileStage(profile, "raw"), prefetch, writer or contextlib.nullcontext():
+        if simple and compress and not deferred:
+            size, hashes = writeRAWCompressed(
+                files, os.path.join(res["out_path"], raws[0]), header.dtype, pool, cache, profile, observers, header.crop, header.color,
+                jobs
+            )
+
+            # Size of compressed data is only known after writing
+            header.compressed_data = True
+            header.compressed_data_size = size
+        elif simple:
+            # Compressed after converting if the element type is converted afterwards
+            hashes = writeRAWSimple(
+                files, os.path.join(res["out_path"], "output.raw"), header.dtype, header.shape[1:],
+                pool, indexes, cache, profile, observers, header.crop, header.color, orientation
+            )
+        else:
+            hashes = writeRAWMultiple(
+                files, res["out_path"], header.dtype, pool, indexes, cache, compress and not deferred, profile, observers, header.crop,
+                writer, header.color
+            )
+            header.compressed_data = compress
+
+
+    #   Narrow to the smallest element type (if chosen automatically)
+    #   =============================================================
+    if auto:
+        # The range is only known after the last slice, the written RAW output is
+        # read and rewritten once more (nothing done if the type stays the same)
+        with profileStage(profile, "narrow"):
+            convertElementType(
+                header, getMinimalElementType(header.element_type, intensity.minimum, intensity.maximum),
+                res["out_path"], raws, simple, None, pyramid, pool, profile
+            )
+
+
+    #   Clip and rescale to intensity window (if asked for)
+    #   ===================================================
+    if statistics is not None:
+        report = statistics.report()
+
+    if window is not None:
+        element_type = header.element_type if res.get("element") is None else res["element"].upper()
+        values = (statistics.percentile(window[0]), statistics.percentile(window[1]))
+        report["window"] = {"percentiles" : list(window), "values" : list(values), "element_type" : element_type}
+
+        with profileStage(profile, "window"):
+            convertElementType(
+                header, element_type, res["out_path"], raws, simple,
+                getRescale(values[0], values[1], getDataType(element_type)), pyramid, pool, profile
+            )
+
+
+
+    #   Reoriented header and compression (if asked for)
+    #   ================================================
+    if orientation is not None:
+        # Element type conversions above go element-wise, the voxels stay in place
+        reorientHeader(header, *orientation)
+
+    if deferred and compress:
+        with profileStage(profile, "compress"):
+            compressRAW(header, res["out_path"], raws, simple, pool, profile, jobs)
+
+    if stats:
+        # Also gathered for -window only, but then not written
+        with open(os.path.join(res["out_path"], "output.stats.json"), "w") as out_file:
+            json.dump(report, out_file, indent=4)
+
+    if cache:
+        for i, hashed in zip(range(0, len(files)) if indexes is None else indexes, hashes):
+            slices[i]["hash"] = hashed
+
+        writeCache(cache_path, information, slices)
+
+
+    #   Create MHD file (after RAW, when everything is known)
+    #   =====================================================
+    closeFrames()
+
+    with profileStage(profile, "mhd"):
+        if pyramid is not None:
+            pyramid.close()
+
+        if masks is not None:
+            masks.close(compress, pool, jobs)
+
+        writeMHD(os.path.join(res["out_path"], "output.mhd"), header)
+
+
+# ================================================================================
+#       Converts the written RAW output to the given ElementType
+#
+#   Slices were written with the element type of the image mode while their
+#   intensity range (or statistics) were gathered. The RAW file(s) and pyramid
+#   levels are converted in place (see convertRAW), slices of LIST 2D on the
+#   pool. Compression is done afterwards (see compressRAW).
+# ================================================================================
+def convertElementType(header, element_type, path, raws, simple, function = None, pyramid = None, pool = None, profile = None):
+    dtype = header.dtype
+    header.element_type = element_type
+    count = len(header.files)
+    changed = header.dtype != dtype or function is not None
+
+    if pyramid is not None and changed:
+        pyramid.convert(dtype, header.dtype, function)
+
+    if not changed:
+        return
+
+    if simple:
+        convertRAW(os.path.join(path, "output.raw"), count, dtype, header.dtype, function, profile)
+        return
+
+    def convertSlice(i):
+        # Slices were written uncompressed (.raw)
+        convertRAW(os.path.join(path, os.path.splitext(raws[i])[0] + ".raw"), 1, dtype, header.dtype, function, profile)
+
+    mapSlices(pool, convertSlice, range(0, count))
+
+
+# ================================================================================
+#       Compresses the RAW output written uncompressed (.raw) to the given raws
+#
+#   Simple output is compressed slab-wise from the memory-mapped output.raw
+#   (name of raws[0]), slices of LIST 2D on the pool. The uncompressed files
+#   are removed.
+# ================================================================================
+def compressRAW(header, path, raws, simple, pool = None, profile = None, jobs = 1):
+    import numpy
+
+    if simple:
+        raw = os.path.join(path, os.path.splitext(raws[0])[0] + ".raw")
+        volume = numpy.memmap(raw, dtype=header.dtype, mode="r", shape=header.shape)
+
+        header.compressed_data = True
+        header.compressed_data_size, _ = writeZlibStream(
+            os.path.join(path, raws[0]), lambda z: (numpy.ascontiguousarray(volume[z]), None), volume.shape[0], pool, profile, jobs
+        )
+
+        del volume
+        os.remove(raw)
+        return
+
+    def compressSlice(i):
+        file = os.path.join(path, os.path.splitext(raws[i])[0] + ".raw")
+        with open(file, "rb") as in_file:
+            data = zlib.compress(in_file.read())
+
+        os.remove(file)
+        with open(os.path.join(path, raws[i]), "wb") as out_file:
+            out_file.write(data)
+
+    mapSlices(pool, compressSlice, range(0, len(raws)))
+
+
+# ================================================================================
+#       Converts a volume input (NPY/ RAW) described by the validated parameters
+#
+#   RAW output Inplace only writes the MHD header, referencing the data within
+#   the input file (HeaderSize skips the .npy header). Simple copies the data by
+#   the system or slab-wise (compressed or not in C order), never reading it as
+#   a whole. Reoriented output (see reorientRAW) is written to output.raw first
+#   (compressed afterwards). Raises a ConversionError if something went wrong.
+# ================================================================================
+def convertVolume(res, compress, cache, factors = [], pool = None, profile = None, stats = False, orient = None, jobs = 1):
+    import numpy
+
+    raw = res["out_raw"].upper()
+    if raw == "MULTIPLE":
+        raise ConversionError("RAW output Multiple is not possible for volume input (NPY/ RAW)!", ERR_RAW)
+
+    if raw == "INPLACE" and compress:
+        raise ConversionError("Volume input referenced in place can not be compressed!", ERR_COMPRESS)
+
+    if cache:
+        raise ConversionError("Cache is not supported for volume input (NPY/ RAW)!", ERR_CACHE)
+
+
+    #   Read header of volume input
+    #   ===========================
+    header = readHeader(
+        res["in_img"], res["in_meta"], res["img_type"], res["in_series"], pool, profile, res.get("element"),
+        res.get("range"), res.get("crop")
+    )
+    volume = header.volume
+
+    if raw == "INPLACE" and not volume.flags.c_contiguous:
+        raise ConversionError("Volume input (or its crop box) is not stored in C order and can not be referenced in place!", ERR_RAW)
+
+    # Create output folder if nonexistant
+    os.makedirs(res["out_path"], exist_ok=True)
+
+    if orient is not None:
+        # Pyramid levels are created from the reoriented volume
+        source = getSourceOrientation(res["in_meta"])
+        reorientHeader(header, source, orient)
+
+    pyramid = Pyramid(res["out_path"], header, factors, profile) if len(factors) != 0 else None
+
+
+    #   Reference or copy RAW volume
+    #   ============================
+    with profileStage(profile, "raw"):
+        if raw == "INPLACE":
+            header.element_data_file = os.path.abspath(res["in_img"])
+        elif orient is not None:
+            header.element_data_file = "output.raw"
+            header.header_size = 0
+
+            path = os.path.join(res["out_path"], header.element_data_file)
+            reorientRAW(volume, path, source, orient, pool, profile)
+            volume = numpy.memmap(path, dtype=volume.dtype, mode="r", shape=header.shape)
+        elif compress:
+            header.element_data_file = "output.zraw"
+            header.header_size = 0
+
+            header.compressed_data = True
+            header.compressed_data_size, _ = writeZlibStream(
+                os.path.join(res["out_path"], header.element_data_file),
+                lambda z: (numpy.ascontiguousarray(volume[z]), None), volume.shape[0], pool, profile, jobs
+            )
+        else:
+            header.element_data_file = "output.raw"
+            offset, header.header_size = header.header_size, 0
+
+            path = os.path.join(res["out_path"], header.element_data_file)
+            if volume.flags.c_contiguous:
+                copyRange(volume.filename, offset, volume.nbytes, path)
+                if profile is not None:
+                    profile.written(volume.nbytes)
+            else:
+                with open(path, "wb") as out_file:
+                    for z in range(0, volume.shape[0]):
+                        out_file.write(numpy.ascontiguousarray(volume[z]))
+
+
+    #   Create pyramid levels and statistics (slab-wise from the memory-mapped volume)
+    #   ==============================================================================
+    statistics = Statistics(volume.dtype) if stats else None
+    observers = [observer for observer in [pyramid, statistics] if observer is not None]
+
+    def addSlab(z):
+        for observer in observers:
+            observer.add(z, volume[z])
+
+    if len(observers) != 0:
+        with profileStage(profile, "pyramid" if pyramid is not None else "stats"):
+            mapSlices(pool, profileSlices(profile, addSlab), range(0, volume.shape[0]))
+
+    if statistics is not None:
+        with open(os.path.join(res["out_path"], "output.stats.json"), "w") as out_file:
+            json.dump(statistics.report(), out_file, indent=4)
+
+    if orient is not None and compress:
+        del volume
+        header.element_data_file = "output.zraw"
+
+        with profileStage(profile, "compress"):
+            compressRAW(header, res["out_path"], [header.element_data_file], True, pool, profile, jobs)
+
+
+    #   Create MHD file
+    #   ===============
+    with profileStage(profile, "mhd"):
+        if pyramid is not None:
+            pyramid.close()
+
+        writeMHD(os.path.join(res["out_path"], "output.mhd"), header)
+
+
+# ================================================================================
+#       Converts the slices of a folder while they arrive (watch mode)
+#
+#   The folder is polled (portable, also on network shares) for numbered slices
+#   ([…].N.xyz, see getSliceNumber). A slice is decoded as soon as its size and
+#   modification time did not change between two polls, and written into its
+#   place of the growing output.raw. As in convert, slices are packed in the
+#   order of their numbers (gaps left out). Slices arriving in order are written
+#   at their final place, output.mhd is replaced whenever more of them are
+#   written. A slice numbered before slices already written is kept apart in
+#   output.spill.raw and merged once after watching (see mergeSpill). Finished
+#   when no slice arrived for the given seconds (or on interrupt). Raises a
+#   ConversionError if a slice does not match the first one or its number is
+#   given more than once.
+# ================================================================================
+def watchSeries(res, timeout, pool = None, profile = None, interval = 0.5):
+    import numpy
+
+    #   Validate input
+    #   ==============
+    if not validateImageType(res["img_type"]) or res["img_type"].upper() in VOLUME_TYPES:
+        raise ConversionError("Image type is not supported (yet)!", ERR_IMG_TYPE)
+
+    if not validateSeries(res["in_series"]):
+        raise ConversionError("Wrong Series given!", ERR_SERIES)
+
+    if not os.path.isdir(res["in_img"]):
+        raise ConversionError("Watch mode requires a folder to watch!", ERR_INPUT)
+
+    meta_info, element_size, element_spacing = readMeta(res["in_meta"], res["in_series"], profile)
+
+    os.makedirs(res["out_path"], exist_ok=True)
+    mhd_path = os.path.join(res["out_path"], "output.mhd")
+
+    header, image = None, None
+    seen, pending = {}, {}
+    numbers = []                                                # numbers of the slices in place (ascending)
+    late = {}                                                   # number -> position in output.spill.raw
+
+    def decode(file):
+        return decodeSlice(file, header.dtype, header.crop)
+
+    def update(count):
+        # Replaced at once, readers never see a partial header
+        header.dim_size = header.dim_size[:2] + (count,)
+        writeMHD(mhd_path + ".tmp", header)
+        os.replace(mhd_path + ".tmp", mhd_path)
+
+    raw_path, spill_path = os.path.join(res["out_path"], "output.raw"), os.path.join(res["out_path"], "output.spill.raw")
+    fd, spill = os.open(raw_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC), None
+    last_change = time.monotonic()
+    try:
+        with profileStage(profile, "watch"):
+            while True:
+                #   Find new slices (unchanged since last poll)
+                #   ===========================================
+                for file in scanImages(res["in_img"], res["img_type"])["files"]:
+                    try:
+                        stat = os.stat(file)
+                        number = getSliceNumber(file)
+                    except (OSError, ValueError):
+                        continue
+
+                    if seen.get(file) == "done":
+                        continue
+
+                    if seen.get(file) != (stat.st_size, stat.st_mtime_ns):
+                        # New or still being written
+                        seen[file] = (stat.st_size, stat.st_mtime_ns)
+                        last_change = time.monotonic()
+                        continue
+
+                    current = readImageHeader(file)
+                    if current is None:
+                        # Not readable (yet)
+                        continue
+
+                    if header is None:
+                        #   First slice: ElementType and size of all slices
+                        #   ===============================================
+                        image = current
+                        (width, height), mode, _, channels = image
+
+                        element_type = getElementType(mode)
+                        if element_type is None:
+                            raise ConversionError(f"The given image(s) bitdepth was not 8-Bit, 16-Bit, 32-Bit, 64-Bit or it was not implemented (correctly): {mode}", ERR_IMG_TYPE_DEPTH)
+
+                        if res.get("crop") is not None:
+                            crop = validateRegion(None, res["crop"], 0, width, height)[1]
+                            width, height = crop[2:]
+
+                        header = MHDHeader(
+                            [], mode, channels, (width, height, 0), element_type,
+                            element_size, element_spacing, meta_info[6]
+                        )
+
+                        if res.get("crop") is not None:
+                            header.crop = crop
+                            header.offset = (crop[0] * element_spacing[0], crop[1] * element_spacing[1], 0)
+
+                        slice_size = width * height * channels * numpy.dtype(header.dtype).itemsize
+                    elif current != image:
+                        print(f"Image differs in type or size or can not be read: {file}")
+                        raise ConversionError("Images differ in type or size, information does not match!", ERR_INPUT_DIFFER)
+
+                    if number in pending or number in late or number in numbers:
+                        raise ConversionError(f"Slice numbers given more than once: [{number}]", ERR_IMG_NAMES)
+
+                    seen[file] = "done"
+                    function = profileSlices(profile, decode)
+                    pending[number] = pool.submit(function, file) if pool is not None else function(file)
+
+
+                #   Write decoded slices into their place (packed by number)
+                #   ========================================================
+                for number in sorted(number for number in pending if not hasattr(pending[number], "done") or pending[number].done()):
+                    data = pending.pop(number)
+                    data = data if not hasattr(data, "result") else data.result()
+
+                    if len(numbers) == 0 or number > numbers[-1]:
+                        writeAt(fd, data, len(numbers) * slice_size)
+                        numbers.append(number)
+                    else:
+                        # Numbered before slices in place, merged after watching
+                        if spill is None:
+                            spill = os.open(spill_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+                        writeAt(spill, data, len(late) * slice_size)
+                        late[number] = len(late)
+                        print(f"Slice {number} numbered before slices already written, merged after watching")
+
+                    if profile is not None:
+                        profile.written(slice_size)
+
+                    last_change = time.monotonic()
+
+                if header is not None and len(numbers) != header.dim_size[2]:
+                    update(len(numbers))
+                    print(f"{len(numbers)} slice(s) ready")
 
-    try:
-        index = args.index("-meta")
-        meta_json = args[index+1]
+                if len(pending) == 0 and time.monotonic() - last_change >= timeout:
+                    break
 
-        assert bool(re.search(r'(?i)meta.json', args[index+1]))
-    except Exception:
-        # No Meta.json given (or using another name which is not implemented yet!)
-        return None
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        # Stopped by the user, output.mhd covers every slice complete so far
+        pass
+    finally:
+        os.close(fd)
+        if spill is not None:
+            os.close(spill)
 
-    del args[index+1]
-    del args[index]
+    if header is None:
+        raise ConversionError("No suitable slice arrived in the watched folder!", ERR_INPUT)
 
-    try:
-        assert len(args) == 0
-    except Exception:
-        # Too many (unknown) parameters given
-        return None
+    if len(late) != 0:
+        with profileStage(profile, "merge"):
+            numbers = mergeSpill(raw_path, spill_path, numbers, late, slice_size, update, profile)
+        print(f"{len(numbers)} slice(s) ready")
 
-    # Return everything structured
-    return {
-        "in_meta" : meta_json,
-        "in_series": img_series,
-        "in_img" :  img_path,
-        "img_type" : img_type,
-        "out_path" : out_path,
-        "out_raw" : out_raw
-    }
+    gaps = [missing for i in range(1, len(numbers)) for missing in range(numbers[i-1] + 1, numbers[i])]
+    if len(gaps) != 0:
+        print(f"Slice numbers missing (gaps in the volume): {gaps[:10]}{' ...' if len(gaps) > 10 else ''}")
 
 
 # ================================================================================
-#                               Validate image type
+#       Merges the slices kept apart in the spill file into the RAW file by number
+#
+#   numbers are the (ascending) numbers of the slices in the RAW file, late maps
+#   the number of every spilled slice to its position in the spill file. The
+#   slices from the first spilled number on are written back to front, so every
+#   slice moves once (never onto one not moved yet). The header is updated by
+#   update(count) to the slices staying in place before, to all slices after
+#   moving. The spill file is removed. Returns the numbers of all slices.
 # ================================================================================
-def validateImageType(given):
-    given = given.upper()
+def mergeSpill(path, spill_path, numbers, late, slice_size, update, profile = None):
+    merged = sorted(numbers + list(late))
+    start = merged.index(min(late))
+    update(start)
 
-    # Supported types
-    if given in [
-            "BMP", "DIB",                   # BMP format
-            "XBM", "XPM",                   # X BitMap format
-            "JPG", "JPEG",                  # JPEG format
-            "PPM", "PBM", "PGM", "PNM",     # Netpbm format
-            "PNG", "EPS", "IM", "TGA", "WEBP" "FPX", "PCD", "PIXAR", "PSD"]:
-        return True
+    fd, spill = os.open(path, os.O_RDWR), os.open(spill_path, os.O_RDONLY)
+    try:
+        for position in range(len(merged) - 1, start - 1, -1):
+            number = merged[position]
+            if number in late:
+                data = readAt(spill, slice_size, late[number] * slice_size)
+            else:
+                data = readAt(fd, slice_size, bisect.bisect_left(numbers, number) * slice_size)
 
-    # Not yet supported types
-    if given in [
-            "FLIC", "FLI", "FLC",           # Flic Animation format
-            "TIFF",                         # Tagged Image File Format (one or multiple)
-            "GIF"]:                         # Graphics Interchange Format
-        print(f"\nThe given format {given} is not yet supported! May come in the future!\n")
+            writeAt(fd, data, position * slice_size)
+            if profile is not None:
+                profile.written(slice_size)
+    finally:
+        os.close(fd)
+        os.close(spill)
 
-    return False
+    os.remove(spill_path)
+    update(len(merged))
+
+    return merged
 
 
 # ================================================================================
-#                       Validate given Series (MRA / DSA)
+#       Converts one shard (part or range of the slices) into a shared output.raw
+#
+#   Every shard runs as an independent process (e.g. one node of a job array).
+#   output.raw is created in the size of the whole volume by the first shard
+#   (or extended), every slice is decoded on the pool and written by pwrite at
+#   its byte offset, so shards never overlap and never lock (read ahead within
+#   the memory budget, if given, see Prefetch). When its slices
+#   are on disk, the shard leaves a marker (output.shard.First-Last.json) with
+#   the MHD header of the whole volume for finalizeShards.
 # ================================================================================
-def validateSeries(given):
-    return given.upper() in ["DSA", "MRA"]
+SHARD_MARKER = re.compile(r"^output\.shard\.([0-9]+)-([0-9]+)\.json$")
 
+def convertShard(res, shard, pool = None, profile = None, max_memory = None, color = None):
+    import numpy
 
-# ================================================================================
-#                   Validate RAW output (SIMPLE / MULTIPLE)
-# ================================================================================
-def validateRAW(given):
-    return given.upper() in ["SIMPLE", "MULTIPLE"]
+    #   Read header of the slices of this shard
+    #   =======================================
+    header = readHeader(
+        res["in_img"], res["in_meta"], res["img_type"], res["in_series"], pool, profile,
+        z_range=shard[1] if shard[0] == "RANGE" else None, crop=res.get("crop"),
+        index=os.path.join(res["out_path"], "output.index.json") if validateSwitch(res.get("index", "False")) else None,
+        shard=shard[1] if shard[0] == "PART" else None, color=color
+    )
+    files = header.files
+    first, last, slices = header.z_range
 
+    if isFrame(files[0]):
+        raise ConversionError("Shards need a folder of slices (not the frames of one file)!", ERR_SHARD)
 
-# ================================================================================
-#               Check if Image input is a single file or folder
-# ================================================================================
-def validateImage(path, img_type):
-    files = []
-    if os.path.isdir(path):
-        for file in os.listdir(path):
-            # Disallow mask files
-            if "mask" in file:
-                continue
+    # Header of the whole volume (only moved by the crop box)
+    header.dim_size = header.dim_size[:2] + (slices,)
+    header.offset = None if header.crop is None else header.offset[:2] + (0,)
+    slice_size = int(numpy.prod(header.shape[1:])) * numpy.dtype(header.dtype).itemsize
 
-            # Check if file name ("type") equals given type
-            if bool(re.search(img_type, file.split(".")[-1], re.IGNORECASE)):
-                 files.append(os.path.join(path, file))
-    elif os.path.isfile(path):
-        # Check if file name ("type") equals given type
-        if bool(re.search(img_type, path.split(".")[-1], re.IGNORECASE)):
-            files.append(path)
 
-    return files
+    #   Write slices at their byte offset into output.raw
+    #   =================================================
+    os.makedirs(res["out_path"], exist_ok=True)
+
+    fd = os.open(os.path.join(res["out_path"], "output.raw"), os.O_RDWR | os.O_CREAT)
+    try:
+        if os.fstat(fd).st_size < slices * slice_size:
+            # Extending is safe while other shards write (never shrinks)
+            os.ftruncate(fd, slices * slice_size)
+
+        def writeSlice(i):
+            writeAt(fd, decodeSlice(files[i], header.dtype, header.crop, header.color), (first + i) * slice_size)
+
+        with profileStage(profile, "raw"), Prefetch(files, max_memory) if max_memory is not None else contextlib.nullcontext():
+            mapSlices(pool, profileSlices(profile, writeSlice), range(0, len(files)))
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if profile is not None:
+        profile.written(len(files) * slice_size)
+
+
+    #   Mark shard as complete
+    #   ======================
+    marker = os.path.join(res["out_path"], f"output.shard.{first}-{last}.json")
+    with open(marker + ".tmp", "w") as out_file:
+        json.dump({
+            "first" : first, "last" : last, "slices" : slices, "size" : slices * slice_size, "header" : header.lines()
+        }, out_file, indent=4)
+    os.replace(marker + ".tmp", marker)
+
+    print(f"Shard {first}:{last} of {slices} slices written")
 
 
 # ================================================================================
-#                   Check if Meta.json is formatted correctly
+#       Writes output.mhd after checking that every shard completed
 #
-#   File should include MRA field, looking sth. like this:
-#   "MRA" : {
-#       "rows" : Int
-#       "columns" : Int
-#       "number of slices" : Int => should equal number of given images!
-#       "slice thickness" : Float
-#       "slice spacing" : Float
-#       "pixel spacing" : [Float, Float]
-#       "anatomical orientation" : String"
-#   }
+#   Only the markers left by convertShard are read: they must describe the same
+#   volume and cover every slice. output.raw is cut to its size (if a former
+#   conversion left it larger) and the markers are removed. Raises a
+#   ConversionError naming the missing slices otherwise.
 # ================================================================================
-def validateMeta(path):
-    with open(path, "r") as in_file:
-        data = json.load(in_file)
+def finalizeShards(path):
+    markers = []
+    if os.path.isdir(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if SHARD_MARKER.match(entry.name):
+                    with open(entry.path, "r") as in_file:
+                        markers.append(dict(json.load(in_file), path = entry.path))
 
-    cols = rows = pxl_size = pxl_space_x = pxl_space_y = pxl_space_z = ana_ori = None
+    if len(markers) == 0:
+        raise ConversionError("No shard completed (no marker found in the output folder)!", ERR_SHARD)
 
-    # Check if there is a MRA field in JSON
-    found = getFieldName("mra", data)
-    if found != None:
-        data = data[found]
+    if any((marker["slices"], marker["size"], marker["header"]) != (markers[0]["slices"], markers[0]["size"], markers[0]["header"])
+           for marker in markers):
+        raise ConversionError("Shards differ in the volume they were written for, convert them again!", ERR_SHARD)
 
-        found = [
-            getFieldName("columns", data),
-            getFieldName("rows", data),
-            getFieldName("slice thickness", data),
-            getFieldName("pixel spacing", data),
-            getFieldName("slice spacing", data),
-            getFieldName("anatomical orientation", data)
-        ]
 
-        # Columns (no default value)
-        if found[0] != None:
-            cols = data[found[0]]
+    #   Check every slice is covered by a shard
+    #   =======================================
+    missing, covered = [], 0
+    for marker in sorted(markers, key=lambda marker: marker["first"]):
+        if marker["first"] > covered:
+            missing.append(f"{covered}:{marker['first']}")
+        covered = max(covered, marker["last"])
 
-        # Rows (no default value)
-        if found[1] != None:
-            rows = data[found[1]]
+    if covered < markers[0]["slices"]:
+        missing.append(f"{covered}:{markers[0]['slices']}")
 
-        # Pixel size
-        if found[2] != None:
-            pxl_size = data[found[2]]
-        else:
-            # Default: 1
-            pxl_size = 1
+    if len(missing) != 0:
+        raise ConversionError(f"Slices of shards missing (not completed): {', '.join(missing)}", ERR_SHARD)
 
-        # Pixel space x/y
-        # TODO: handle list length != 2
-        if found[3] != None:
-            pxl_space_x = data[found[3]][0]
-            pxl_space_y = data[found[3]][1]
-        else:
-            # Default: 1/1
-            pxl_space_x = 1
-            pxl_space_y = 1
 
-        # Pixel space z
-        if found[4] != None:
-            pxl_space_z = data[found[4]]
-        else:
-            # Default: 1
-            pxl_space_z = 1
+    #   Create MHD file
+    #   ===============
+    raw = os.path.join(path, "output.raw")
+    size = os.path.getsize(raw) if os.path.isfile(raw) else 0
+    expected = markers[0]["size"]
+    if size < expected:
+        raise ConversionError("output.raw is smaller than the volume of the shards!", ERR_SHARD)
 
-        # Anatomical Orientation
-        if found[5] != None:
-            ana_ori = data[found[5]]
-        else:
-            # Default: RAI
-            ana_ori = "RAI"
+    if size > expected:
+        os.truncate(raw, expected)
 
-    return cols, rows, pxl_size, pxl_space_x, pxl_space_y, pxl_space_z, ana_ori
+    mhd_path = os.path.join(path, "output.mhd")
+    with open(mhd_path + ".tmp", "w") as mhd:
+        for line in markers[0]["header"]:
+            mhd.write(line + "\n")
+    os.replace(mhd_path + ".tmp", mhd_path)
+
+    for marker in markers:
+        os.remove(marker["path"])
+
+    print(f"{markers[0]['slices']} slices of {len(markers)} shard(s) complete, output.mhd written")
 
 
 # ================================================================================
-#               Checks if the anatomical orientation is correct
+#               Reads the manifest of all series to convert in batch mode
 #
-#   Anatomical orientation should look like this: [R|L][A|P][S|I]
-#   - R (right) / L (left)
-#   - A (anterior) / P (posterior)
-#   - S (superior) / I (inferior)
+#   Manifest is a JSON list of objects or a CSV file with a header row, both with
+#   the fields "in", "meta", "series", "out" (and optional "type", "raw", "cache",
+#   "compress", "element", "pyramid", "range", "crop", "index", "stats", "window", "orient", "mask", "shard", "max-memory", "color"). Paths are relative to the manifest. Returns the parameters of
+#   every series as given by validateParameters or None if incorrect. Every
+#   series needs its own output folder (only shards of one series share one).
 # ================================================================================
-def validateAnatomicalOrientation(given):
-    if len(given) != 3:
-        # Anatomical orientation is wrongly formatted
+MANIFEST_FIELDS = {
+    "series" : ("in_series", "MRA"),
+    "type" : ("img_type", "PNG"),
+    "raw" : ("out_raw", "Simple"),
+    "cache" : ("cache", "False"),
+    "compress" : ("compress", "False"),
+    "element" : ("element", None),
+    "pyramid" : ("pyramid", "False"),
+    "range" : ("range", None),
+    "crop" : ("crop", None),
+    "index" : ("index", "False"),
+    "stats" : ("stats", "False"),
+    "window" : ("window", None),
+    "orient" : ("orient", None),
+    "mask" : ("mask", "False"),
+    "shard" : ("shard", None),
+    "max-memory" : ("max_memory", None),
+    "color" : ("color", None)
+}
+
+def readManifest(path):
+    try:
+        with open(path, "r", newline="") as in_file:
+            if path.lower().endswith(".csv"):
+                entries = list(csv.DictReader(in_file))
+            else:
+                entries = json.load(in_file)
+
+        assert isinstance(entries, list) and len(entries) > 0
+    except Exception:
         return None
 
-    given = given.upper()
+    base = os.path.dirname(os.path.abspath(path))
 
-    if "R" in given:        r = True
-    else:
-        if "L" in given:    r = False
-        else:
-            # neather "R" nor "L" found
+    series = []
+    for entry in entries:
+        if not isinstance(entry, dict):
             return None
 
-    if "A" in given:        a = True
-    else:
-        if "P" in given:    a = False
-        else:
-            # neather "A" nor "P" found
+        entry = {str(key).strip().lower(): value for key, value in entry.items()}
+        if not entry.get("in") or not entry.get("meta") or not entry.get("out"):
+            # Input file/ folder, Meta.json and output folder are required
             return None
 
-    if "S" in given:        s = True
-    else:
-        if "I" in given:    s = False
-        else:
-            # neather "S" nor "S" found
+        if not re.search(r'(?i)meta.json', str(entry["meta"])):
+            # Same as given by validateParameters (no other name implemented yet)
             return None
 
-    # Rebuild the given string (so it works on Slicer)
-    return ("R" if r else "L") + ("A" if a else "P") + ("S" if s else "I")
+        res = {
+            "in_meta" : os.path.join(base, entry["meta"]),
+            "in_img" : os.path.join(base, entry["in"]),
+            "out_path" : os.path.join(base, entry["out"]),
+            "jobs" : "1"
+        }
+
+        # Optional fields (with the same defaults as given by validateParameters)
+        for field, (key, default) in MANIFEST_FIELDS.items():
+            res[key] = str(entry[field]) if entry.get(field) not in [None, ""] else default
+        res["out_raw"] = res["out_raw"].capitalize()
 
+        series.append(res)
+
+    outputs = collections.defaultdict(list)
+    for res in series:
+        outputs[os.path.realpath(res["out_path"])].append(res)
+
+    if any(len(shared) > 1 and any(res["shard"] is None for res in shared) for shared in outputs.values()):
+        # Series would overwrite each others output.mhd/ output.raw
+        return None
+
+    return series
 
 
 # ================================================================================
-#                                   MAIN-ROUTINE:
-#   1) Validate parameters
-#   2) Validate input image type
-#   3) Validate series type
-#   4) Validate RAW output type
-#   5) Validate input file/folder
-#   6) Validate meta information
-#   7) Validate anatomical orientation
-#   8) MHD output
-#   9) RAW output
+#       Converts all series given, sharing one worker pool for decoding
 #
-#   TODO: inform user, if only one image given but "Multiple" raw output selected!
+#   Multiple series are converted at once (as many as jobs) while their slices
+#   are all decoded on the same pool. Returns a status/ timing report per series.
+# ================================================================================
+def convertBatch(series, jobs):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+    def convertSeries(res):
+        status = {
+            "in" : res["in_img"],
+            "meta" : res["in_meta"],
+            "out" : res["out_path"],
+            "status" : "ok",
+            "code" : 0,
+            "message" : None
+        }
+
+        start = time.perf_counter()
+        try:
+            # Every series shares the pool of all jobs
+            convert(dict(res, jobs = str(jobs)), pool)
+        except ConversionError as error:
+            status.update(status = "failed", code = error.code, message = str(error))
+        except Exception as error:
+            # Unexpected errors (e.g. while writing) must not stop other series
+            status.update(status = "failed", code = None, message = repr(error))
+
+        status["seconds"] = round(time.perf_counter() - start, 3)
+        return status
+
+    if pool is None:
+        return list(map(convertSeries, series))
+
+    # Series are only waiting for their slices, they do not occupy the pool
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as series_pool:
+        report = list(series_pool.map(convertSeries, series))
+
+    pool.shutdown()
+    return report
+
+
+
+# ================================================================================
+#                                   MAIN-ROUTINE:
+#   1) Check for help request
+#   2) Batch mode: validate parameters, read manifest and convert all series
+#   3) Validate parameters
+#   4) Validate number of jobs and profile
+#   5) Convert image input (see convert)
+#   6) Output profile report (if asked for)
 # ================================================================================
 if __name__ == "__main__":
     args = sys.argv[1:]
@@ -398,215 +4080,94 @@ if __name__ == "__main__":
         exit(locals()["code"] if "code" in locals() else 0)
 
 
-    #   Validate parameters
-    #   ===================
-    res = validateParameters(args)
-    if not res:
-        # Parameters are not correct!
-        print("Parameters are not correct!")
-        printHelp()
-        exit(ERR_PARAMS_INCORRECT)
-
-    #   Validate input image type
-    #   =========================
-    if not validateImageType(res["img_type"]):
-        # Image type not supported
-        print("Image type is not supported (yet)!")
-        printHelp()
-        exit(ERR_IMG_TYPE)
-
-
-    #   Validate series type
-    #   ====================
-    if not validateSeries(res["in_series"]):
-        # Series is neather DSA nor MRA
-        print("Wrong Series given!")
-        printHelp()
-        exit(ERR_SERIES)
-
-
-    #   Validate RAW output
-    #   ===================
-    if not validateRAW(res["out_raw"]):
-        # RAW output matches neather Simple nor Multiple
-        print("Wrong RAW output given!")
-        printHelp()
-        exit(ERR_RAW)
+    #   Batch mode (manifest of multiple series)
+    #   ========================================
+    if "-batch" in args:
+        res = validateBatchParameters(args)
+        if not res:
+            # Parameters are not correct!
+            print("Parameters are not correct!")
+            printHelp()
+            exit(ERR_PARAMS_INCORRECT)
 
+        jobs = validateJobs(res["jobs"])
+        if not jobs:
+            # Number of jobs is no positive integer
+            print("Wrong number of jobs given!")
+            printHelp()
+            exit(ERR_JOBS)
 
-    #   Validate input file/ folder is correct
-    #   ======================================
-    files = validateImage(res["in_img"], res["img_type"])
-    if len(files) == 0:
-        print("No suitable path given or directory does not contain images from given type!")
-        printHelp()
-        exit(ERR_INPUT)
+        series = readManifest(res["manifest"])
+        if not series:
+            print("Manifest could not be read, is missing input/ meta/ output information or series share an output folder!")
+            printHelp()
+            exit(ERR_MANIFEST)
 
-    im = Image.open(files[0])
-    width, height = im.size
-    bit_depth = im.mode
+        report = convertBatch(series, jobs)
+        for status in report:
+            print(f"{status['status'].upper():6} {status['seconds']:>9.3f}s  {status['in']}"
+                    + (f"  ({status['code']}: {status['message']})" if status["message"] else ""))
 
-    if len(files) != 1:
-        for i in range(1, len(files)-1):
-            im = Image.open(files[0])
-            lwidth, lheight = im.size
-            lbit_depth = im.mode
+        # Output report to file
+        os.makedirs(res["out_path"], exist_ok=True)
+        with open(os.path.join(res["out_path"], "report.json"), "w") as out_file:
+            json.dump(report, out_file, indent=4)
 
-            if width != lwidth or height != lheight or bit_depth != lbit_depth:
-                print("Images differ in type or size, information does not match!")
-                printHelp()
-                exit(ERR_INPUT_DIFFER)
+        exit(ERR_BATCH if any(status["status"] != "ok" for status in report) else 0)
 
 
-    #   Validate meta data
-    #   ==================
-    meta_info = list(validateMeta(res["in_meta"]))
-    if None in meta_info:
-        print("Meta.json was not fully functional as relevant portions for MHD where missing!")
+    #   Validate parameters
+    #   ===================
+    profile = Profile()
+    with profile.stage("parameters"):
+        res = validateParameters(args)
+    if not res:
+        # Parameters are not correct!
+        print("Parameters are not correct!")
         printHelp()
-        exit(ERR_META)
+        exit(ERR_PARAMS_INCORRECT)
 
 
-    #   Validate anatomical orientation
-    #   ===============================
-    meta_info[6] = validateAnatomicalOrientation(meta_info[6])
-    if not meta_info[6]:
-        # anatomical orientation is wrong or can not be corrected!
-        print("Anatomical orientation in meta data wrong!")
+    #   Validate number of jobs and profile
+    #   ===================================
+    with profile.stage("parameters"):
+        jobs = validateJobs(res["jobs"])
+        latency = validateSwitch(res["latency"])
+    if not jobs:
+        # Number of jobs is no positive integer
+        print("Wrong number of jobs given!")
         printHelp()
-        exit(ERR_META_AO)
-
-
-    #   Create MHD file from skeleton
-    #   =============================
-    #   TODO: Fields: Position, TransformMatrix, Offset, CenterOfRotation
-    information = [
-        "ObejctType = Image",
-        "NDims = 3",
-        "DimSize = ",
-        "ElementType = ",
-        "HeaderSize = 0",
-        "BinaryData = True ",
-        "BinaryDataByteOrderMSB = ",
-        "ElementSize = ",
-        "ElementSpacing = ",
-        "ElementByteOrderMSB = ",
-        "AnatomicalOrientation = ",
-        "ElementDataFile = "
-    ]
+        exit(ERR_JOBS)
 
-    # Data type of image(s) (https://pillow.readthedocs.io/en/5.1.x/handbook/concepts.html#modes)
-    if bit_depth in ['1', 'L', 'La', 'LA', 'P', 'PA', 'RGB', 'RGBX', 'RGBa', 'RGBA', 'CMYK', 'YCbCr', 'LAB', 'HSV']:
-        # Everything 1 Byte data types -> MET_UCHAR or MET_CHAR (assume first)
-        information[3] += "MET_UCHAR"
-    elif bit_depth in ['I;16', 'I;16L', 'I;16B', 'I;16N', 'BGR;15', 'BGR;16']:
-        # 2 Byte unsigned integer pixels -> MET_USHORT
-        information[3] += "MET_USHORT"
-    elif bit_depth in ['BGR;24', 'BGR;32']:
-        # 4 Byte unsigned integer pixels -> MET_UINT
-        information[3] += "MET_UINT"
-    elif bit_depth == "I":
-        # 4 Byte signed integer pixels -> MET_INT
-        information[3] += "MET_INT"
-    elif bit_depth == "F":
-        # 4 Byte floating point pixels -> MET_FLOAT
-        information[3] += "MET_FLOAT"
-    else:
-        print(f"The given image(s) bitdepth was not 8-Bit, 16-Bit, 32-Bit, 64-Bit or it was not implemented (correctly): {bit_depth}")
+    if latency is None:
+        print("Wrong slice latency option given!")
         printHelp()
-        exit(ERR_IMG_TYPE_DEPTH)
-
-    # Dimensions of output voxel box (width + length)
-    information[2] += str(width) + " " + str(height)
-
-    if res["in_series"].upper() == "DSA":
-        # Dimensions of output voxel box (height)
-        information[2] += " " + str(len(files))
-
-        # ElementSize (X Y Z)
-        information[7] += "1 1 1"
-
-        # ElementSpacing (X Y Z)
-        information[8] += "1 1 1"
-    else:
-        # Dimensions of output voxel box (height)
-        information[2] += " " + str(len(files))
-
-        # ElementSize (X Y Z)
-        information[7] += str(meta_info[2]) + " " + str(meta_info[2]) + " " + str(meta_info[2])
-
-        # ElementSpacing (X Y Z)
-        information[8] += str(meta_info[3]) + " " + str(meta_info[4]) + " " + str(meta_info[5])
-
-    # ElementByteOrderMSB
-    if sys.byteorder == "little":
-        information[6] += "False"
-        information[9] += "False"
-    else:
-        information[6] += "True"
-        information[9] += "True"
-
-    # AnatomicalOrientation
-    information[10] += meta_info[6]
+        exit(ERR_PROFILE)
 
-    # ElementDataFile (one or list)
-    if len(files) > 1:
-        try:
-            # sort by file names where filenames are numbered ([…].0.xyz ... […].1000.xyz ...)
-            files.sort(key = lambda file: int(file.split(os.path.sep)[-1].split(".")[-2]))
-        except Exception:
-            print("MHD files require slices (images) to be sorted but given file names can not be sorted!")
-            printHelp()
-            exit(ERR_IMG_NAMES)
-
-    if len(files) != 1 and res["out_raw"] != "Simple":
-        information[11] += "LIST 2D"
-        for file in files:
-            # replace the file extension with raw
-            information.append(
-                os.path.splitext(file.split(os.path.sep)[-1])[0] + ".raw"
-            )
-    else:
-        information[11] += "output.raw"
+    if res["profile"] is None:
+        profile = None
+    elif latency:
+        profile.latencies = []
 
-    # Create output folder if nonexistant
-    os.makedirs(res["out_path"], exist_ok=True)
 
-    # Output MHD skeleton to file
-    with open(os.path.join(res["out_path"], "output.mhd"), "w") as mhd:
-        for i in range(0, len(information)):
-            mhd.write(information[i] + "\n")
+    #   Convert image input
+    #   ===================
+    # Decode slices on a worker pool if more than one job is given
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
 
+    try:
+        convert(res, pool, profile)
+    except ConversionError as error:
+        print(error)
+        printHelp()
+        exit(error.code)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
-    #   Create RAW image if only one image is given
-    #   ===========================================
-    if    "MET_CHAR" in information[3]:          dtype = numpy.int8
-    elif  "MET_UCHAR" in information[3]:         dtype = numpy.uint8
-    elif  "MET_USHORT" in information[3]:        dtype = numpy.uint16
-    elif  "MET_SHORT" in information[3]:         dtype = numpy.int16
-    elif ("MET_UINT" in information[3] or
-          "MET-ULONG" in information[3]):        dtype = numpy.uint32
-    elif ("MET_INT" in information[3] or
-          "MET_LONG" in information[3]):         dtype = numpy.int32
-    elif  "MET_ULONG_LONG" in information[3]:    dtype = numpy.uint64
-    elif  "MET_LONG_LONG" in information[3]:     dtype = numpy.int64
-    elif  "MET_FLOAT" in information[3]:         dtype = numpy.single
-    elif  "MET_DOUBLE" in information[3]:        dtype = numpy.double
-
-
-    if len(files) == 1 or res["out_raw"] == "Simple":
-        images = numpy.array(Image.open(files[0]))
-        if len(files) > 1:
-            for i in range(1, len(files)):
-                images = numpy.append(
-                    images, numpy.array(Image.open(files[i]))
-                )
-        with open(os.path.join(res["out_path"], "output.raw"), "wb") as raw:
-            raw.write(bytearray(images.astype(dtype).flatten()))
-    else:
-        for file in files:
-            image_2d = numpy.array(Image.open(file))
 
-            # Save array to file (https://gist.github.com/jdumas/280952624ea4ad68e385b77cdba632c1#file-volume-py-L39)
-            with open(os.path.join(res["out_path"], os.path.splitext(file.split(os.path.sep)[-1])[0] + ".raw"), "wb") as raw:
-                raw.write(bytearray(image_2d.astype(dtype).flatten()))
+    #   Output profile report
+    #   =====================
+    if profile is not None:
+        with open(res["profile"], "w") as out_file:
+            json.dump(profile.report(), out_file, indent=4)
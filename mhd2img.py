@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import os
+import os.path
+import zlib
+import threading
+import concurrent.futures
+
+import img2mhd
+
+
+
+# ================================================================================
+#                   Error codes returned by the program
+# ================================================================================
+ERR_PARAMS_INCORRECT = 1    # parameters incorrect
+ERR_INPUT = 2               # MHD file (or its data) incorrect
+ERR_IMG_TYPE = 3            # output image type not supported
+ERR_VERIFY = 4              # slices differ from their source
+
+
+# ================================================================================
+#       Prints the help message (also done when something went wrong!)
+# ================================================================================
+def printHelp():
+    print("\nmhd2img.py : Reading MetaIO (MHD) files and exporting their slices\n"
+            + "====================================================================\n")
+
+    print("USAGE:\n"
+            + "\tpython3 mhd2img.py -in {File} -out {Folder} -type {Image type} -slices {First:Last} -jobs {Number}\n"
+            + "\tpython3 mhd2img.py -in {File} -verify {Files} -type {Image type} -jobs {Number}\n\n\n"
+            + "Input file:\t\tMHD file (Simple or LIST 2D, compressed or not)\n\n"
+            + "Output folder:\t\tFolder for the exported slices ([…].N.xyz)\n"
+            + "\t\t\t=> Default: Current Directory\n\n"
+            + "Image type:\t\t{PNG | TIFF/TIF}\n"
+            + "\t\t\t=> Default: PNG\n\n"
+            + "Slice range:\t\t{First:Last} (Last excluded, both optional)\n"
+            + "\t\t\t=> Default: All slices\n\n"
+            + "Verify against:\t\tFolder of the source slices (compared slice by slice)\n\n"
+            + "Number of jobs:\t\t{Number of parallel workers}\n"
+            + "\t\t\t=> Default: 1\n")
+
+
+# ================================================================================
+#           Validates that all parameters given are correct!
+# ================================================================================
+def validateParameters(args):
+    defaults = {
+        "-in" : None,
+        "-out" : os.getcwd(),
+        "-type" : "PNG",
+        "-slices" : ":",
+        "-verify" : None,
+        "-jobs" : "1"
+    }
+
+    # Assert parameters always followed by values
+    if len(args) % 2 != 0:
+        return None
+
+    res = dict(defaults)
+    for i in range(0, len(args), 2):
+        if args[i] not in defaults or args[i+1].startswith("-"):
+            return None
+        res[args[i]] = args[i+1]
+
+    z_range = img2mhd.validateRange(res["-slices"])
+    jobs = img2mhd.validateJobs(res["-jobs"])
+    if res["-in"] is None or z_range is None or jobs is None:
+        return None
+
+    return {
+        "in" : res["-in"],
+        "out" : res["-out"],
+        "type" : res["-type"],
+        "range" : z_range,
+        "verify" : res["-verify"],
+        "jobs" : jobs
+    }
+
+
+# ================================================================================
+#       Reads a MHD file into a MHDHeader (see img2mhd.py)
+#
+#   ElementDataFile is the data file (relative to the MHD file) or the list of
+#   slice files (LIST 2D). Returns None if the file is not a readable MHD file.
+# ================================================================================
+def readMHD(path):
+    try:
+        with open(path, "r") as in_file:
+            lines = [line.strip() for line in in_file if line.strip() != ""]
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    fields = {}
+    for i in range(0, len(lines)):
+        key, _, value = lines[i].partition("=")
+        fields[key.strip()] = value.strip()
+
+        if key.strip() == "ElementDataFile":
+            if value.strip().startswith("LIST"):
+                # One file per slice follows
+                fields["ElementDataFile"] = lines[i+1:]
+            break
+
+    try:
+        dim_size = tuple(int(value) for value in fields["DimSize"].split())
+        if len(dim_size) == 2:
+            dim_size = dim_size + (1,)
+
+        spacing = tuple(float(value) for value in fields.get("ElementSpacing", fields.get("ElementSize", "1 1 1")).split())
+        header = img2mhd.MHDHeader(
+            [], None, int(fields.get("ElementNumberOfChannels", 1)), dim_size, fields["ElementType"],
+            tuple(float(value) for value in fields.get("ElementSize", fields.get("ElementSpacing", "1 1 1")).split()),
+            spacing, fields.get("AnatomicalOrientation", "RAI")
+        )
+
+        header.byte_order_msb = fields.get("ElementByteOrderMSB", fields.get("BinaryDataByteOrderMSB", "False")).upper() == "TRUE"
+        header.compressed_data = fields.get("CompressedData", "False").upper() == "TRUE"
+        header.header_size = int(fields.get("HeaderSize", 0))
+        header.element_data_file = fields["ElementDataFile"]
+
+        origin = fields.get("Offset", fields.get("Position", fields.get("Origin")))
+        if origin is not None:
+            header.offset = tuple(float(value) for value in origin.split())
+    except (KeyError, ValueError):
+        return None
+
+    if header.dtype is None:
+        return None
+
+    return header
+
+
+# ================================================================================
+#           Volume read lazily, slice by slice (Z first, like numpy.memmap)
+#
+#   Used for data which can not be memory-mapped as a whole (LIST 2D, compressed
+#   data). Indexing with an integer reads one slice, with a slice (or tuple) only
+#   the slices selected. numpy.asarray reads everything.
+# ================================================================================
+class LazyVolume:
+    def __init__(self, shape, dtype, function):
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len(shape)
+        self.function = function
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        import numpy
+
+        index = index if isinstance(index, tuple) else (index,)
+        if isinstance(index[0], (int, numpy.integer)):
+            return self.function(int(index[0]) % self.shape[0])[index[1:]]
+
+        slices = [self.function(z) for z in range(0, self.shape[0])[index[0]]]
+        volume = numpy.stack(slices) if len(slices) != 0 else numpy.empty((0,) + self.shape[1:], dtype=self.dtype)
+        return volume[(slice(None),) + index[1:]]
+
+    def __array__(self, dtype = None, copy = None):
+        volume = self[:]
+        return volume if dtype is None else volume.astype(dtype)
+
+
+# ================================================================================
+#       Opens the volume of a MHD file without reading it
+#
+#   Uncompressed data in one file is returned as read-only numpy.memmap. LIST 2D
+#   maps every slice file on access, compressed data is decompressed on access
+#   (one zlib stream is read forward, so slices are best read in order).
+#
+#   Returns the MHDHeader and the volume (Z, Y, X[, C]) or None if incorrect.
+# ================================================================================
+def openVolume(path):
+    import numpy
+
+    header = readMHD(path)
+    if header is None:
+        return None, None
+
+    folder = os.path.dirname(os.path.abspath(path))
+    dtype = numpy.dtype(header.dtype).newbyteorder(">" if header.byte_order_msb else "<")
+    shape = header.shape
+    slice_size = int(numpy.prod(shape[1:])) * dtype.itemsize
+
+    def getPath(name):
+        return name if os.path.isabs(name) else os.path.join(folder, name)
+
+    #   LIST 2D: one file per slice
+    #   ===========================
+    if isinstance(header.element_data_file, list):
+        files = [getPath(name) for name in header.element_data_file]
+        if len(files) != shape[0]:
+            return header, None
+
+        def readSlice(z):
+            if header.compressed_data:
+                with open(files[z], "rb") as in_file:
+                    data = zlib.decompress(in_file.read(), bufsize=slice_size)
+                return numpy.frombuffer(data, dtype=dtype).reshape(shape[1:])
+
+            return numpy.memmap(files[z], dtype=dtype, mode="r", shape=shape[1:])
+
+        return header, LazyVolume(shape, dtype, readSlice)
+
+    file = getPath(header.element_data_file)
+    if not os.path.isfile(file):
+        return header, None
+
+
+    #   Compressed: zlib stream with decompressor checkpoints
+    #   ======================================================
+    if header.compressed_data:
+        # checkpoints[z]: file position and decompressor state at the start of slice z
+        checkpoints = [(0, zlib.decompressobj())]
+        advance = threading.Lock()
+        record = threading.Lock()
+
+        def inflate(z):
+            position, decompressor = checkpoints[z]
+            decompressor = decompressor.copy()
+            data = bytearray()
+
+            with open(file, "rb") as in_file:
+                in_file.seek(position)
+                while len(data) < slice_size:
+                    chunk = decompressor.unconsumed_tail
+                    if len(chunk) == 0:
+                        chunk = in_file.read(1 << 20)
+                        position += len(chunk)
+                        if len(chunk) == 0:
+                            raise ValueError("Compressed data ends before slice " + str(z))
+                    # never more than the slice, the rest stays in the decompressor
+                    data += decompressor.decompress(chunk, slice_size - len(data))
+
+            with record:
+                if len(checkpoints) == z + 1:
+                    checkpoints.append((position, decompressor))
+            return data
+
+        def readCompressed(z):
+            if z >= len(checkpoints):
+                # Only the stream ahead of the last checkpoint is read sequentially,
+                # slices behind are decompressed in parallel from their own checkpoint
+                with advance:
+                    while len(checkpoints) <= z:
+                        inflate(len(checkpoints) - 1)
+
+            return numpy.frombuffer(inflate(z), dtype=dtype).reshape(shape[1:])
+
+        return header, LazyVolume(shape, dtype, readCompressed)
+
+
+    #   Simple: memory-mapped as a whole
+    #   ================================
+    offset = header.header_size
+    if offset < 0:
+        # Data at the end of the file
+        offset = os.path.getsize(file) - slice_size * shape[0]
+
+    if offset < 0 or os.path.getsize(file) < offset + slice_size * shape[0]:
+        return header, None
+
+    return header, numpy.memmap(file, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+# ================================================================================
+#       Exports the given slices as images (numbered […].N.xyz, in parallel)
+#
+#   Slices are converted to a type the image format can store (native byte
+#   order, 16 bit for PNG, 32 bit for TIFF). Returns the files written or None
+#   if the element type can not be stored by the image format.
+# ================================================================================
+EXPORT_TYPES = {
+    "PNG" : ("png", ["uint8", "uint16"]),
+    "TIFF" : ("tiff", ["uint8", "uint16", "int32", "float32"]),
+    "TIF" : ("tif", ["uint8", "uint16", "int32", "float32"])
+}
+
+def exportSlices(volume, path, img_type, indexes, name = "slice", pool = None):
+    import numpy
+    from PIL import Image
+
+    extension, dtypes = EXPORT_TYPES[img_type.upper()]
+    dtype = numpy.dtype(volume.dtype).newbyteorder("=")
+
+    if dtype.name not in dtypes:
+        # Smallest type storing every value (e.g. signed 16 bit as 32 bit)
+        candidates = [candidate for candidate in dtypes if numpy.can_cast(dtype, candidate)]
+        if len(candidates) == 0:
+            return None
+
+        dtype = numpy.dtype(candidates[0])
+
+    os.makedirs(path, exist_ok=True)
+
+    def exportSlice(z):
+        data = numpy.ascontiguousarray(volume[z], dtype=dtype)
+        if dtype == numpy.uint16 and data.ndim == 2:
+            im = Image.frombytes("I;16", (data.shape[1], data.shape[0]), data.astype("<u2").tobytes())
+        else:
+            im = Image.fromarray(data)
+
+        file = os.path.join(path, f"{name}.{z}.{extension}")
+        im.save(file)
+        return file
+
+    return img2mhd.mapSlices(pool, exportSlice, indexes)
+
+
+# ================================================================================
+#       Compares every slice of the volume with its source slice
+#
+#   Source slices are found and sorted as done by img2mhd.py, one slice of each
+#   is held in memory at a time (per worker). Returns the indexes of the slices
+#   which differ (all if the number of slices differs).
+# ================================================================================
+def verifySlices(volume, path, img_type, pool = None):
+    import numpy
+
+    files = img2mhd.scanImages(path, img_type)["files"]
+    if len(files) != volume.shape[0]:
+        return list(range(0, volume.shape[0]))
+
+    def compareSlice(z):
+        source, _ = img2mhd.loadSlice(files[z])
+        data = numpy.asarray(volume[z])
+
+        # Slices of other size (e.g. cropped) or type (e.g. converted) differ as well
+        if source.shape != data.shape or source.dtype.newbyteorder("=") != data.dtype.newbyteorder("="):
+            return True
+
+        return not numpy.array_equal(data, source)
+
+    differ = img2mhd.mapSlices(pool, compareSlice, range(0, volume.shape[0]))
+    return [z for z in range(0, len(differ)) if differ[z]]
+
+
+# ================================================================================
+#                                   MAIN-ROUTINE:
+#   1) Validate parameters
+#   2) Open MHD file (memory-mapped, nothing is read)
+#   3) Verify against source slices or export selected slices
+# ================================================================================
+if __name__ == "__main__":
+    #   Validate parameters
+    #   ===================
+    res = validateParameters(sys.argv[1:])
+    if not res:
+        print("Parameters are not correct!")
+        printHelp()
+        exit(ERR_PARAMS_INCORRECT)
+
+
+    #   Open MHD file
+    #   =============
+    header, volume = openVolume(res["in"])
+    if volume is None:
+        print("MHD file or its data can not be read!")
+        printHelp()
+        exit(ERR_INPUT)
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=res["jobs"]) if res["jobs"] > 1 else None
+
+
+    #   Verify against source slices
+    #   ============================
+    if res["verify"] is not None:
+        differ = verifySlices(volume, res["verify"], res["type"], pool)
+        if pool is not None:
+            pool.shutdown()
+
+        if len(differ) != 0:
+            print(f"{len(differ)} slice(s) differ from their source: {differ[:10]}{' ...' if len(differ) > 10 else ''}")
+            exit(ERR_VERIFY)
+
+        print(f"All {volume.shape[0]} slices match their source.")
+        exit(0)
+
+
+    #   Export selected slices
+    #   ======================
+    if res["type"].upper() not in EXPORT_TYPES:
+        print("Image type is not supported for export!")
+        printHelp()
+        exit(ERR_IMG_TYPE)
+
+    first, last = res["range"]
+    indexes = range(min(first, volume.shape[0]), volume.shape[0] if last is None else min(last, volume.shape[0]))
+
+    name = os.path.splitext(os.path.basename(res["in"]))[0]
+    files = exportSlices(volume, res["out"], res["type"], indexes, name, pool)
+    if pool is not None:
+        pool.shutdown()
+
+    if files is None:
+        print(f"Element type {header.element_type} can not be stored as {res['type'].upper()}!")
+        printHelp()
+        exit(ERR_IMG_TYPE)
+
+    print(f"{len(files)} slice(s) exported to {res['out']}")